@@ -0,0 +1,113 @@
+import collections
+import threading
+import time
+
+LATENCY_SAMPLES = 1000
+
+
+class Batch:
+    def __init__(self):
+        self.requests = []
+        # When each request was submitted
+        self.submitted_at = []
+        self.size = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+    def add(self, size, request, submitted_at):
+        self.requests.append(request)
+        self.submitted_at.append(submitted_at)
+        self.size += size
+        return len(self.requests) - 1
+
+
+class MicroBatcher:
+    # Merges requests that share a key into one run. The first request for a
+    # key leads: it waits up to max_wait for others to join, or until the
+    # batch is full, then runs the whole batch while the others wait for it.
+    # run_batch takes a list of requests and returns one result per request.
+    def __init__(self, run_batch, max_wait, max_batch_size):
+        self.run_batch = run_batch
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.open_batches = {}
+        self.latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.started_at = time.time()
+
+    def submit(self, key, size, request):
+        start = time.time()
+        with self.lock:
+            batch = self.open_batches.get(key)
+            leader = batch is None or batch.size + size > self.max_batch_size
+            if leader:
+                if batch is not None:
+                    # Nothing more can join the batch this one replaces, so
+                    # its leader need not wait out max_wait
+                    batch.full.set()
+                batch = Batch()
+                self.open_batches[key] = batch
+            index = batch.add(size, request, start)
+            if batch.size >= self.max_batch_size:
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                if self.open_batches.get(key) is batch:
+                    del self.open_batches[key]
+            self.run(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+        return batch.results[index]
+
+    def run(self, batch):
+        print(f"Running batch of {len(batch.requests)} requests, {batch.size} images")
+        try:
+            batch.results = self.run_batch(batch.requests)
+        except Exception as e:
+            batch.error = e
+        finally:
+            done_at = time.time()
+            with self.lock:
+                self.batches += 1
+                self.batched_requests += len(batch.requests)
+                if not batch.error:
+                    # Every request of the batch is answered now
+                    self.latencies.extend(done_at - t for t in batch.submitted_at)
+                    self.requests += len(batch.requests)
+            batch.done.set()
+
+        if not batch.error:
+            print(f"Batching: {self.stats()}")
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            requests = self.requests
+            batches = self.batches
+            batched_requests = self.batched_requests
+
+        def percentile(p):
+            if not latencies:
+                return 0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        elapsed = time.time() - self.started_at
+        return {
+            "requests": requests,
+            "batches": batches,
+            "mean_batch_requests": batched_requests / batches if batches else 0,
+            "throughput_requests_s": requests / elapsed if elapsed else 0,
+            "latency_p50": percentile(0.5),
+            "latency_p90": percentile(0.9),
+            "latency_p99": percentile(0.99),
+        }
@@ -1,88 +1,345 @@
 import os
-import urllib.request
+import collections
+import shutil
+import socket
+import struct
 import subprocess
 import threading
 import time
 import json
-import urllib
 import uuid
 import json
 import os
 import websocket
 import random
 from weights_downloader import WeightsDownloader
-from urllib.error import URLError
 import requests
 
 from helpers.ComfyUI_IPAdapter_plus import ComfyUI_IPAdapter_plus
 from helpers.ComfyUI_Controlnet_Aux import ComfyUI_Controlnet_Aux
+from helpers.profiler import PromptTrace
+from helpers.workflow_templates import WorkflowOverlay
+
+# ComfyUI prints this once its web server has bound the port
+SERVER_LISTENING_LINE = "To see the GUI go to"
+SERVER_LOG_LINES = 50
+
+# Binary websocket event sent by helpers/custom_nodes/save_image_websocket_raw.py
+RAW_IMAGE_EVENT = 100
+# Binary websocket event ComfyUI sends for sampler previews, followed by the
+# image format and the encoded image
+PREVIEW_IMAGE_EVENT = 1
+PREVIEW_IMAGE_FORMATS = {1: "jpg", 2: "png"}
+CUSTOM_NODES = ["helpers/custom_nodes/save_image_websocket_raw.py"]
+
+
+class PromptError(Exception):
+    # A prompt that did not finish, with the node it stopped at if known
+    def __init__(self, message, prompt_id, node_id=None, class_type=None):
+        if node_id is not None:
+            message = f"{message} (node {node_id}, class type: {class_type})"
+        super().__init__(message)
+        self.prompt_id = prompt_id
+        self.node_id = node_id
+        self.class_type = class_type
+
+
+class PromptExecutionError(PromptError):
+    pass
+
+
+class PromptInterruptedError(PromptError):
+    pass
+
+
+class PromptTimeoutError(PromptError, TimeoutError):
+    pass
+
+
+def prompt_error(error_type, workflow, data):
+    # The error for an execution_error or execution_interrupted message
+    node_id = data.get("node_id")
+    class_type = workflow.get(node_id, {}).get("class_type", data.get("node_type"))
+    if error_type == "execution_error":
+        return PromptExecutionError(
+            f"ComfyUI error: {data.get('exception_type')}: {data.get('exception_message', '').strip()}",
+            data["prompt_id"],
+            node_id,
+            class_type,
+        )
+    return PromptInterruptedError(
+        "ComfyUI interrupted the prompt", data["prompt_id"], node_id, class_type
+    )
+
+
+def parse_binary_message(out):
+    # Returns ("image", image) for a raw output image, ("preview", (data,
+    # image_format)) for a sampler preview and (None, None) for anything else
+    (event,) = struct.unpack(">I", out[:4])
+    if event == RAW_IMAGE_EVENT:
+        width, height, index = struct.unpack(">III", out[4:16])
+        # A view rather than a slice, so the pixels are never copied
+        return "image", {
+            "width": width,
+            "height": height,
+            "index": index,
+            "pixels": memoryview(out)[16:],
+        }
+    if event == PREVIEW_IMAGE_EVENT:
+        (image_type,) = struct.unpack(">I", out[4:8])
+        return "preview", (
+            memoryview(out)[8:],
+            PREVIEW_IMAGE_FORMATS.get(image_type, "jpg"),
+        )
+    return None, None
 
 
 class ComfyUI:
-    def __init__(self, server_address):
-        self.weights_downloader = WeightsDownloader()
+    def __init__(
+        self,
+        server_address,
+        preview_method="none",
+        weights_downloader=None,
+        extra_args=None,
+    ):
+        # Servers that share a models directory share a downloader, so a
+        # weight is only fetched once
+        self.weights_downloader = weights_downloader or WeightsDownloader()
+        self.weights_filetypes = tuple(self.weights_downloader.supported_filetypes)
         self.server_address = server_address
-        ComfyUI_IPAdapter_plus.prepare()
+        # none, auto, latent2rgb or taesd. taesd falls back to latent2rgb
+        # unless the TAESD decoders are in ComfyUI/models/vae_approx
+        self.preview_method = preview_method
+        # More ComfyUI flags, such as --cuda-device
+        self.extra_args = extra_args or []
+        self.client_id = str(uuid.uuid4())
+        self.ws = None
+        # One keep-alive HTTP session for every call to the server
+        self.http = requests.Session()
+        self.pending_prompts = set()
+        self.bridge_timings = {}
+        self.output_images = []
+        self.on_image = None
+        self.on_preview = None
+        self.node_timings = {}
+        self.trace = None
+        self.execution_counts = {}
+
+    def install_custom_nodes(self):
+        for custom_node in CUSTOM_NODES:
+            shutil.copy(custom_node, "ComfyUI/custom_nodes/")
 
     def start_server(self, output_directory, input_directory):
+        # Only a server this process starts needs the nodes and folders, a
+        # client that just resolves weights, such as get_weights.py, doesn't
+        ComfyUI_IPAdapter_plus.prepare()
+        self.install_custom_nodes()
         self.input_directory = input_directory
         self.output_directory = output_directory
+        self.boot_timings = {}
+        # Name, start and end of each boot phase, for the setup's boot trace
+        self.boot_spans = []
 
-        self.download_pre_start_models()
-
-        server_thread = threading.Thread(
-            target=self.run_server, args=(output_directory, input_directory)
+        # The server does not read the pre-start models while it imports,
+        # only a prompt does, so they download while it starts. Their span
+        # ends when they finish, not when the server is ready.
+        start_time = time.time()
+        recorded = threading.Event()
+
+        def downloaded(future):
+            end_time = time.time()
+            self.boot_timings["pre_start_downloads"] = end_time - start_time
+            self.boot_spans.append(("pre_start_downloads", start_time, end_time))
+            recorded.set()
+
+        pre_start = self.download_pre_start_models()
+        pre_start.add_done_callback(downloaded)
+        self.run_server(output_directory, input_directory)
+        self.wait_for_server(timeout=60)
+        pre_start.result()
+        # Done callbacks can run just after result() returns
+        recorded.wait()
+
+        print(
+            "Server running: "
+            + ", ".join(f"{k} {v:.3f}s" for k, v in self.boot_timings.items())
         )
-        server_thread.start()
 
+    def use_running_server(self, output_directory, input_directory, timeout=60):
+        # For a server started elsewhere, such as the benchmark's stand-in.
+        # Both directories must be the ones that server was started with.
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.boot_spans = []
         start_time = time.time()
         while not self.is_server_running():
-            if time.time() - start_time > 60:  # If more than a minute has passed
-                raise TimeoutError("Server did not start within 60 seconds")
-            time.sleep(1)  # Wait for 1 second before checking again
-
-        print("Server running")
+            if time.time() - start_time > timeout:
+                raise TimeoutError(
+                    f"No server at {self.server_address} within {timeout} seconds"
+                )
+            time.sleep(0.05)
+        self.boot_spans.append(("first_reachable", start_time, time.time()))
+        print(f"Using server at {self.server_address}")
 
     def run_server(self, output_directory, input_directory):
-        command = f"python ./ComfyUI/main.py --output-directory {output_directory} --input-directory {input_directory} --disable-metadata --preview-method none --gpu-only"
-        server_process = subprocess.Popen(command, shell=True)
-        server_process.wait()
+        host, port = self.server_address.rsplit(":", 1)
+        command = [
+            "python",
+            "-u",
+            "./ComfyUI/main.py",
+            "--output-directory",
+            output_directory,
+            "--input-directory",
+            input_directory,
+            "--disable-metadata",
+            "--preview-method",
+            self.preview_method,
+            "--gpu-only",
+            "--listen",
+            host,
+            "--port",
+            port,
+            *self.extra_args,
+        ]
+        self.server_log = collections.deque(maxlen=SERVER_LOG_LINES)
+        self.server_listening = threading.Event()
+        self.server_started_at = time.time()
+        self.server_process = subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1,
+        )
+        self.server_output_thread = threading.Thread(
+            target=self.read_server_output, daemon=True
+        )
+        self.server_output_thread.start()
+
+    def stop_server(self, timeout=10):
+        self.close()
+        self.server_process.terminate()
+        try:
+            self.server_process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.server_process.kill()
+            self.server_process.wait()
+
+    def read_server_output(self):
+        for line in self.server_process.stdout:
+            print(line, end="")
+            self.server_log.append(line.rstrip())
+            if SERVER_LISTENING_LINE in line and not self.server_listening.is_set():
+                self.boot_timings["server_import"] = (
+                    time.time() - self.server_started_at
+                )
+                self.boot_spans.append(
+                    ("server_import", self.server_started_at, time.time())
+                )
+                self.server_listening.set()
+
+        # Output only ends when the process does, wake the waiter to see it
+        self.server_listening.set()
+
+    def wait_for_server(self, timeout):
+        delay = 0.005
+        while True:
+            exit_code = self.server_process.poll()
+            if exit_code is not None:
+                self.server_output_thread.join(timeout=1)
+                raise RuntimeError(
+                    f"ComfyUI server exited with code {exit_code} before it was ready. Last output:\n"
+                    + "\n".join(self.server_log)
+                )
+
+            if self.is_port_open() and self.is_server_running():
+                break
+
+            if time.time() - self.server_started_at > timeout:
+                raise TimeoutError(
+                    f"Server did not start within {timeout} seconds. Last output:\n"
+                    + "\n".join(self.server_log)
+                )
+
+            # Back off quickly while the server imports, then probe tightly
+            # once it has printed that it is listening
+            if self.server_listening.is_set():
+                time.sleep(0.005)
+            else:
+                self.server_listening.wait(delay)
+                delay = min(delay * 2, 0.25)
+
+        self.boot_timings["first_reachable"] = time.time() - self.server_started_at
+        self.boot_spans.append(("first_reachable", self.server_started_at, time.time()))
+
+    def is_port_open(self):
+        host, port = self.server_address.rsplit(":", 1)
+        try:
+            with socket.create_connection((host, int(port)), timeout=0.1):
+                return True
+        except OSError:
+            return False
 
     def is_server_running(self):
         try:
-            with urllib.request.urlopen(
+            response = self.http.get(
                 "http://{}/history/{}".format(self.server_address, "123")
-            ) as response:
-                return response.status == 200
-        except URLError:
+            )
+            return response.status_code == 200
+        except requests.exceptions.ConnectionError:
             return False
 
     def download_pre_start_models(self):
-        # Some models need to be downloaded and loaded before starting ComfyUI
-        self.weights_downloader.download_torch_checkpoints()
+        # Some models need to be in place before the first prompt, where
+        # ComfyUI cannot download them. Returns a future.
+        return self.weights_downloader.download_torch_checkpoints()
+
+    def node_weights(self, node):
+        weights = []
+        weights_filetypes = self.weights_filetypes
+
+        for handler in [ComfyUI_IPAdapter_plus, ComfyUI_Controlnet_Aux]:
+            handler.add_weights(weights, node)
+
+        if "inputs" in node:
+            for input in node["inputs"].values():
+                if isinstance(input, str):
+                    if input.endswith(weights_filetypes):
+                        weights.append(input)
+        return weights
+
+    def collect_weights(self, workflow):
+        # Weights are collected in node order so the download pool starts
+        # with whatever the first nodes of the graph load
+        weights = []
+        for node_id, node in workflow.items():
+            if isinstance(workflow, WorkflowOverlay) and workflow.is_shared(node_id):
+                weights.extend(
+                    workflow.template.node_weights(node_id, self.node_weights)
+                )
+            else:
+                weights.extend(self.node_weights(node))
+        return weights
 
-    def handle_weights(self, workflow):
+    def handle_weights(self, workflow, wait=True):
         print("Checking weights")
-        weights_to_download = []
-        weights_filetypes = self.weights_downloader.supported_filetypes
-
-        for node in workflow.values():
-            for handler in [ComfyUI_IPAdapter_plus, ComfyUI_Controlnet_Aux]:
-                handler.add_weights(weights_to_download, node)
-
-            if "inputs" in node:
-                for input in node["inputs"].values():
-                    if isinstance(input, str):
-                        if any(input.endswith(ft) for ft in weights_filetypes):
-                            weights_to_download.append(input)
-
-        weights_to_download = list(set(weights_to_download))
-
-        for weight in weights_to_download:
-            self.weights_downloader.download_weights(weight)
-            print(f"✅ {weight}")
-
+        plan = self.weights_downloader.download_plan(self.collect_weights(workflow))
+        if wait:
+            self.wait_for_weights(plan)
+        return plan
+
+    def wait_for_weights(self, plan, weights=None):
+        # ComfyUI validates every loader input against the files on disk when
+        # a prompt is queued, so a run has to wait for its whole plan
+        plan.wait(weights)
+        report = plan.report()
+        if report["downloaded"]:
+            total_megabytes = report["bytes"] / (1024 * 1024)
+            print(
+                f"⌛️ Downloaded {report['downloaded']} of {report['weights']} weights in {report['seconds']:.2f}s, size: {total_megabytes:.2f}MB, {report['throughput_mb_s']:.2f}MB/s"
+            )
         print("====================================")
+        return report
 
     def is_image_or_video_value(self, value):
         filetypes = [".png", ".jpg", ".jpeg", ".webp", ".mp4", ".webm"]
@@ -126,66 +383,203 @@ class ComfyUI:
         print("====================================")
 
     def connect(self):
-        self.client_id = str(uuid.uuid4())
+        # The websocket stays open across predictions, only reconnect when
+        # it has dropped. ComfyUI routes messages by client id, which is
+        # fixed for the life of this object.
+        if self.ws is not None and self.ws.connected:
+            return
+
+        self.close()
+        start = time.perf_counter()
         self.ws = websocket.WebSocket()
         self.ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
+        self.record_bridge_timing("ws_connect", start)
+
+    def close(self):
+        if self.ws is not None:
+            try:
+                self.ws.close()
+            except (websocket.WebSocketException, OSError):
+                pass
+            self.ws = None
+
+    def record_bridge_timing(self, name, start):
+        elapsed = time.perf_counter() - start
+        self.bridge_timings[name] = self.bridge_timings.get(name, 0) + elapsed
+
+    def report_bridge_timings(self):
+        timings = self.bridge_timings
+        self.bridge_timings = {}
+        total = sum(timings.values())
+        print(
+            f"Bridge overhead: {total * 1000:.2f}ms ("
+            + ", ".join(f"{k} {v * 1000:.2f}ms" for k, v in timings.items())
+            + ")"
+        )
+        return timings
 
     def post_request(self, endpoint, data=None):
-        url = f"http://{self.server_address}{endpoint}"
-        headers = {"Content-Type": "application/json"} if data else {}
-        json_data = json.dumps(data).encode("utf-8") if data else None
-        req = urllib.request.Request(
-            url, data=json_data, headers=headers, method="POST"
-        )
-        with urllib.request.urlopen(req) as response:
-            if response.status != 200:
-                print(f"Failed: {endpoint}, status code: {response.status}")
+        start = time.perf_counter()
+        response = self.http.post(f"http://{self.server_address}{endpoint}", json=data)
+        self.record_bridge_timing(endpoint, start)
+        if response.status_code != 200:
+            print(f"Failed: {endpoint}, status code: {response.status_code}")
 
     # https://github.com/comfyanonymous/ComfyUI/blob/master/server.py
     def clear_queue(self):
+        # Nothing of ours can be queued or running if every prompt we
+        # submitted has reported completion
+        if not self.pending_prompts:
+            return
         self.post_request("/queue", {"clear": True})
         self.post_request("/interrupt")
+        self.pending_prompts.clear()
 
-    def queue_prompt(self, prompt):
-        try:
-            # Prompt is the loaded workflow (prompt is the label comfyUI uses)
-            p = {"prompt": prompt, "client_id": self.client_id}
-            data = json.dumps(p).encode("utf-8")
-            req = urllib.request.Request(
-                f"http://{self.server_address}/prompt?{self.client_id}", data=data
-            )
+    def free_memory(self, unload_models=True, free_memory=False):
+        # ComfyUI applies this once the running prompt finishes, so before
+        # anything queued after it
+        self.post_request(
+            "/free", {"unload_models": unload_models, "free_memory": free_memory}
+        )
 
-            output = json.loads(urllib.request.urlopen(req).read())
-            return output["prompt_id"]
-        except urllib.error.HTTPError as e:
-            print(f"ComfyUI error: {e.code} {e.reason}")
-            http_error = True
+    def queue_prompt(self, prompt):
+        # Prompt is the loaded workflow (prompt is the label comfyUI uses)
+        if isinstance(prompt, WorkflowOverlay):
+            prompt_json = prompt.to_json()
+        else:
+            prompt_json = json.dumps(prompt)
+        data = f'{{"prompt": {prompt_json}, "client_id": "{self.client_id}"}}'
+
+        start = time.perf_counter()
+        response = self.http.post(
+            f"http://{self.server_address}/prompt?{self.client_id}",
+            data=data.encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        self.record_bridge_timing("queue_prompt", start)
 
-        if http_error:
+        if response.status_code != 200:
+            print(f"ComfyUI error: {response.status_code} {response.reason}")
             raise Exception(
                 "ComfyUI Error – Your workflow could not be run. This usually happens if you’re trying to use an unsupported node. Check the logs for 'KeyError: ' details, and go to https://github.com/fofr/cog-comfyui to see the list of supported custom nodes."
             )
 
-    def wait_for_prompt_completion(self, workflow, prompt_id):
+        prompt_id = response.json()["prompt_id"]
+        self.pending_prompts.add(prompt_id)
+        return prompt_id
+
+    def receive(self, prompt_id, timeout=None):
+        try:
+            self.ws.settimeout(timeout)
+            return self.ws.recv()
+        except websocket.WebSocketTimeoutException:
+            return None
+        except (websocket.WebSocketException, OSError) as e:
+            print(f"Websocket disconnected ({e}), reconnecting")
+            self.close()
+            self.connect()
+            # Messages sent while we were away are lost, so check whether
+            # the prompt finished or failed in the meantime
+            history = self.fetch_history(prompt_id).get(prompt_id)
+            if history is None:
+                return None
+            for event, data in history.get("status", {}).get("messages", []):
+                if event in ["execution_error", "execution_interrupted"]:
+                    return json.dumps({"type": event, "data": data})
+            return json.dumps(
+                {
+                    "type": "executing",
+                    "data": {"node": None, "prompt_id": prompt_id},
+                }
+            )
+
+    def cancel_prompt(self, prompt_id):
+        # Drop the prompt if it is still queued and stop it if it is running.
+        # Only one of our prompts is ever on the server at a time, so the
+        # interrupt cannot stop someone else's.
+        self.post_request("/queue", {"delete": [prompt_id]})
+        self.post_request("/interrupt")
+        self.pending_prompts.discard(prompt_id)
+
+    def wait_for_prompt_completion(self, workflow, prompt_id, timeout=None):
+        trace = self.trace
+        self.node_timings = trace.node_timings
+        self.execution_counts = {"executed": 0, "cached": 0}
+        deadline = time.time() + timeout if timeout else None
         while True:
-            out = self.ws.recv()
+            remaining = None
+            if deadline:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.cancel_prompt(prompt_id)
+                    raise PromptTimeoutError(
+                        f"Prompt did not finish within {timeout} seconds",
+                        prompt_id,
+                        trace.current_node,
+                        trace.node_info(trace.current_node)[0],
+                    )
+
+            out = self.receive(prompt_id, remaining)
             if isinstance(out, str):
                 message = json.loads(out)
-                if message["type"] == "executing":
+                if message["type"] == "execution_start":
+                    if message["data"]["prompt_id"] == prompt_id:
+                        trace.end("queue_wait")
+                elif message["type"] in ["execution_error", "execution_interrupted"]:
+                    if message["data"]["prompt_id"] == prompt_id:
+                        self.pending_prompts.discard(prompt_id)
+                        raise prompt_error(message["type"], workflow, message["data"])
+                elif message["type"] == "execution_cached":
+                    if message["data"]["prompt_id"] == prompt_id:
+                        cached_nodes = message["data"]["nodes"]
+                        trace.cached(cached_nodes)
+                        self.execution_counts["cached"] = len(cached_nodes)
+                        print(f"Cached nodes: {', '.join(cached_nodes)}")
+                elif message["type"] == "progress":
+                    data = message["data"]
+                    # Older servers do not say which prompt the step belongs to
+                    if data.get("prompt_id", prompt_id) == prompt_id:
+                        node_id = data.get("node") or trace.current_node
+                        trace.step(data["value"], data["max"], node_id)
+                        print(
+                            f"Progress: node {node_id}, step {data['value']}/{data['max']}"
+                        )
+                elif message["type"] == "executing":
                     data = message["data"]
+                    if data["prompt_id"] == prompt_id:
+                        trace.enter_node(data["node"])
                     if data["node"] is None and data["prompt_id"] == prompt_id:
+                        trace.begin("output_collection")
+                        self.pending_prompts.discard(prompt_id)
+                        print(
+                            f"Executed {self.execution_counts['executed']} nodes, {self.execution_counts['cached']} cached"
+                        )
                         break
                     elif data["prompt_id"] == prompt_id:
+                        self.execution_counts["executed"] += 1
                         node = workflow.get(data["node"], {})
                         meta = node.get("_meta", {})
                         class_type = node.get("class_type", "Unknown")
                         print(
                             f"Executing node {data['node']}, title: {meta.get('title', 'Unknown')}, class type: {class_type}"
                         )
+            elif isinstance(out, bytes):
+                self.handle_binary_message(out)
             else:
                 continue
 
-    def load_workflow(self, workflow, handle_inputs=False, handle_weights=False):
+    def handle_binary_message(self, out):
+        kind, value = parse_binary_message(out)
+        if kind == "image":
+            self.output_images.append(value)
+            if self.on_image:
+                self.on_image(value)
+        elif kind == "preview" and self.on_preview:
+            self.on_preview(*value)
+
+    def load_workflow(
+        self, workflow, handle_inputs=False, handle_weights=False, wait_for_weights=True
+    ):
         if not isinstance(workflow, dict):
             wf = json.loads(workflow)
         else:
@@ -194,7 +588,7 @@ class ComfyUI:
         if handle_inputs:
             self.handle_inputs(wf)
         if handle_weights:
-            self.handle_weights(wf)
+            self.handle_weights(wf, wait=wait_for_weights)
         return wf
 
     def randomise_input_seed(self, input_key, inputs):
@@ -210,19 +604,38 @@ class ComfyUI:
             for seed_key in seed_keys:
                 self.randomise_input_seed(seed_key, inputs)
 
-    def run_workflow(self, workflow):
+    def run_workflow(
+        self, workflow, on_image=None, on_preview=None, timeout=None, labels=None
+    ):
         print("Running workflow")
         # self.reset_execution_cache()
+        self.output_images = []
+        self.on_image = on_image
+        self.on_preview = on_preview
 
+        queued_at = time.time()
         prompt_id = self.queue_prompt(workflow)
-        self.wait_for_prompt_completion(workflow, prompt_id)
-        output_json = self.get_history(prompt_id)
-        print("outputs: ", output_json)
+        # labels are saved with the trace, such as the preset that ran
+        self.trace = PromptTrace(prompt_id, workflow, labels)
+        self.trace.started_at = queued_at
+        self.trace.add_span("queue_prompt", "phase", queued_at, time.time())
+        self.trace.begin("queue_wait")
+        try:
+            self.wait_for_prompt_completion(workflow, prompt_id, timeout)
+            output_json = self.get_history(prompt_id)
+            print("outputs: ", output_json)
+        finally:
+            self.trace.finish()
+        self.trace.report()
+        self.trace.bridge_timings = self.report_bridge_timings()
         print("====================================")
+        return self.output_images
+
+    def fetch_history(self, prompt_id):
+        start = time.perf_counter()
+        response = self.http.get(f"http://{self.server_address}/history/{prompt_id}")
+        self.record_bridge_timing("get_history", start)
+        return response.json()
 
     def get_history(self, prompt_id):
-        with urllib.request.urlopen(
-            f"http://{self.server_address}/history/{prompt_id}"
-        ) as response:
-            output = json.loads(response.read())
-            return output[prompt_id]["outputs"]
+        return self.fetch_history(prompt_id)[prompt_id]["outputs"]
@@ -0,0 +1,251 @@
+import asyncio
+import json
+import time
+import uuid
+
+import aiohttp
+
+from helpers.comfyui import PromptTimeoutError, parse_binary_message, prompt_error
+from helpers.profiler import PromptTrace
+from helpers.workflow_templates import WorkflowOverlay
+
+# Put on a prompt's queue when the websocket drops
+DISCONNECTED = object()
+
+
+class PromptRun:
+    # A prompt in flight: its messages from the shared websocket and the
+    # callbacks for its outputs
+    def __init__(self, prompt_id, workflow, trace, on_image, on_preview):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.trace = trace
+        self.on_image = on_image
+        self.on_preview = on_preview
+        self.messages = asyncio.Queue()
+        self.bridge_timings = {}
+        self.execution_counts = {"executed": 0, "cached": 0}
+
+    def record_bridge_timing(self, name, start):
+        elapsed = time.perf_counter() - start
+        self.bridge_timings[name] = self.bridge_timings.get(name, 0) + elapsed
+
+
+class AsyncComfyUI:
+    # asyncio client for a ComfyUI server that ComfyUI (helpers/comfyui.py)
+    # has started. One HTTP session and one websocket are shared by every
+    # prompt. A reader task routes websocket messages to the prompt they
+    # name. Binary frames do not name a prompt. ComfyUI runs one prompt at a
+    # time, so they go to the prompt that started executing last.
+    def __init__(self, server_address):
+        self.server_address = server_address
+        self.client_id = str(uuid.uuid4())
+        self.session = None
+        self.ws = None
+        self.reader = None
+        self.runs = {}
+        self.executing = None
+        self.connect_lock = asyncio.Lock()
+        # Held from posting a prompt until its run is registered, so the
+        # reader cannot see the prompt's first messages before that
+        self.queue_lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.ws is not None and not self.ws.closed:
+                return
+            if self.session is None:
+                self.session = aiohttp.ClientSession()
+            self.ws = await self.session.ws_connect(
+                f"ws://{self.server_address}/ws?clientId={self.client_id}",
+                # Raw output images are larger than the default limit
+                max_msg_size=0,
+            )
+            self.reader = asyncio.create_task(self.read(self.ws))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.session is not None:
+            await self.session.close()
+        self.ws = None
+        self.session = None
+
+    async def read(self, ws):
+        try:
+            async for message in ws:
+                async with self.queue_lock:
+                    if message.type == aiohttp.WSMsgType.TEXT:
+                        self.dispatch(json.loads(message.data))
+                    elif message.type == aiohttp.WSMsgType.BINARY:
+                        run = self.runs.get(self.executing)
+                        if run:
+                            run.messages.put_nowait(message.data)
+        finally:
+            print("Websocket disconnected")
+            for run in self.runs.values():
+                run.messages.put_nowait(DISCONNECTED)
+
+    def dispatch(self, message):
+        data = message.get("data", {})
+        prompt_id = data.get("prompt_id")
+        if message["type"] == "execution_start":
+            self.executing = prompt_id
+        # Older servers do not say which prompt a progress message is for
+        if prompt_id is None and message["type"] == "progress":
+            prompt_id = self.executing
+        run = self.runs.get(prompt_id)
+        if run:
+            run.messages.put_nowait(message)
+
+    async def post_request(self, run, endpoint, data=None):
+        start = time.perf_counter()
+        async with self.session.post(
+            f"http://{self.server_address}{endpoint}", json=data
+        ) as response:
+            if response.status != 200:
+                print(f"Failed: {endpoint}, status code: {response.status}")
+        if run:
+            run.record_bridge_timing(endpoint, start)
+
+    async def queue_prompt(self, prompt):
+        if isinstance(prompt, WorkflowOverlay):
+            prompt_json = prompt.to_json()
+        else:
+            prompt_json = json.dumps(prompt)
+        data = f'{{"prompt": {prompt_json}, "client_id": "{self.client_id}"}}'
+
+        async with self.session.post(
+            f"http://{self.server_address}/prompt?{self.client_id}",
+            data=data.encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        ) as response:
+            if response.status != 200:
+                print(f"ComfyUI error: {response.status} {response.reason}")
+                raise Exception(
+                    "ComfyUI Error – Your workflow could not be run. This usually happens if you’re trying to use an unsupported node. Check the logs for 'KeyError: ' details, and go to https://github.com/fofr/cog-comfyui to see the list of supported custom nodes."
+                )
+            return (await response.json())["prompt_id"]
+
+    async def fetch_history(self, run):
+        start = time.perf_counter()
+        async with self.session.get(
+            f"http://{self.server_address}/history/{run.prompt_id}"
+        ) as response:
+            history = await response.json()
+        run.record_bridge_timing("get_history", start)
+        return history
+
+    async def cancel_prompt(self, run):
+        # Drop the prompt if it is still queued and stop it if it is running
+        await self.post_request(run, "/queue", {"delete": [run.prompt_id]})
+        if self.executing == run.prompt_id:
+            await self.post_request(run, "/interrupt")
+
+    async def recover(self, run):
+        # Messages sent while the websocket was down are lost, so check
+        # whether the prompt finished or failed in the meantime
+        await self.connect()
+        history = (await self.fetch_history(run)).get(run.prompt_id)
+        if history is None:
+            return None
+        for event, data in history.get("status", {}).get("messages", []):
+            if event in ["execution_error", "execution_interrupted"]:
+                return {"type": event, "data": data}
+        return {"type": "executing", "data": {"node": None, "prompt_id": run.prompt_id}}
+
+    async def wait_for_prompt_completion(self, run, timeout=None):
+        # The timeout counts from the prompt's first message, once it starts
+        # executing, so a prompt queued behind a hung one is not failed
+        # with it. Raises asyncio.TimeoutError.
+        trace = run.trace
+        loop = asyncio.get_running_loop()
+        deadline = None
+        while True:
+            if deadline is None:
+                message = await run.messages.get()
+                if timeout:
+                    deadline = loop.time() + timeout
+            else:
+                message = await asyncio.wait_for(
+                    run.messages.get(), max(0, deadline - loop.time())
+                )
+            if message is DISCONNECTED:
+                message = await self.recover(run)
+                if message is None:
+                    continue
+
+            if isinstance(message, bytes):
+                kind, value = parse_binary_message(message)
+                if kind == "image" and run.on_image:
+                    run.on_image(value)
+                elif kind == "preview" and run.on_preview:
+                    run.on_preview(*value)
+                continue
+
+            data = message["data"]
+            if message["type"] == "execution_start":
+                trace.end("queue_wait")
+            elif message["type"] in ["execution_error", "execution_interrupted"]:
+                raise prompt_error(message["type"], run.workflow, data)
+            elif message["type"] == "execution_cached":
+                trace.cached(data["nodes"])
+                run.execution_counts["cached"] = len(data["nodes"])
+            elif message["type"] == "progress":
+                node_id = data.get("node") or trace.current_node
+                trace.step(data["value"], data["max"], node_id)
+                print(f"Progress: node {node_id}, step {data['value']}/{data['max']}")
+            elif message["type"] == "executing":
+                trace.enter_node(data["node"])
+                if data["node"] is None:
+                    trace.begin("output_collection")
+                    print(
+                        f"Executed {run.execution_counts['executed']} nodes, {run.execution_counts['cached']} cached"
+                    )
+                    return
+                run.execution_counts["executed"] += 1
+                class_type, title = trace.node_info(data["node"])
+                print(
+                    f"Executing node {data['node']}, title: {title}, class type: {class_type}"
+                )
+
+    async def run_workflow(
+        self, workflow, on_image=None, on_preview=None, timeout=None, labels=None
+    ):
+        # Returns the prompt's trace. Outputs go to on_image as they arrive.
+        await self.connect()
+        queued_at = time.time()
+        async with self.queue_lock:
+            start = time.perf_counter()
+            prompt_id = await self.queue_prompt(workflow)
+            # labels are saved with the trace, such as the preset that ran
+            trace = PromptTrace(prompt_id, workflow, labels)
+            run = PromptRun(prompt_id, workflow, trace, on_image, on_preview)
+            run.record_bridge_timing("queue_prompt", start)
+            self.runs[prompt_id] = run
+        print(f"Running workflow {prompt_id}")
+        trace.started_at = queued_at
+        trace.add_span("queue_prompt", "phase", queued_at, time.time())
+        trace.begin("queue_wait")
+
+        try:
+            await self.wait_for_prompt_completion(run, timeout)
+        except asyncio.TimeoutError:
+            await self.cancel_prompt(run)
+            raise PromptTimeoutError(
+                f"Prompt did not finish within {timeout} seconds of starting",
+                prompt_id,
+                trace.current_node,
+                trace.node_info(trace.current_node)[0],
+            )
+        except asyncio.CancelledError:
+            # The caller went away, the server should not keep working for it
+            await asyncio.shield(self.cancel_prompt(run))
+            raise
+        finally:
+            del self.runs[prompt_id]
+            trace.finish()
+
+        trace.bridge_timings = run.bridge_timings
+        trace.report()
+        return trace
@@ -0,0 +1,45 @@
+# Installed into ComfyUI/custom_nodes by helpers/comfyui.py
+#
+# Sends each output image to the client that queued the prompt as a binary
+# websocket frame of raw RGB pixels, so nothing is encoded or written to disk
+# on the ComfyUI side. Frame layout after ComfyUI's 4 byte event type:
+# width, height, batch index (big endian uint32 each), then width * height * 3
+# bytes of RGB.
+import struct
+
+import numpy as np
+from server import PromptServer
+
+RAW_IMAGE_EVENT = 100
+
+
+class SaveImageWebsocketRaw:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"images": ("IMAGE",)}}
+
+    RETURN_TYPES = ()
+    FUNCTION = "save_images"
+    OUTPUT_NODE = True
+    CATEGORY = "api node/image"
+
+    def save_images(self, images):
+        server = PromptServer.instance
+        for index, image in enumerate(images):
+            pixels = np.clip(255.0 * image.cpu().numpy(), 0, 255).astype(np.uint8)
+            height, width = pixels.shape[:2]
+            header = struct.pack(">III", width, height, index)
+            server.send_sync(
+                RAW_IMAGE_EVENT, header + pixels[:, :, :3].tobytes(), server.client_id
+            )
+        return {}
+
+    @classmethod
+    def IS_CHANGED(s, images):
+        # Always send, a cached result would leave the client with no images
+        return float("nan")
+
+
+NODE_CLASS_MAPPINGS = {
+    "SaveImageWebsocketRaw": SaveImageWebsocketRaw,
+}
@@ -0,0 +1,127 @@
+import collections
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+def link_or_copy(source, destination):
+    # The destination's mtime is set either way, a link would otherwise keep
+    # the source's, and pruning goes by mtime
+    if not os.path.exists(destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+    os.utime(destination)
+
+
+class FileCache:
+    # Disk-bounded LRU cache of files produced by workflow nodes, such as
+    # IPAdapter embeds or depth maps, keyed by the inputs that made them.
+    # The LRU order and entry sizes are held in memory, the files live on
+    # disk with a JSON sidecar per entry so the cache survives restarts.
+    def __init__(self, name, directory, max_bytes):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self.load_entries()
+
+    def load_entries(self):
+        metadata_files = [f for f in os.listdir(self.directory) if f.endswith(".json")]
+        metadata_files.sort(
+            key=lambda f: os.path.getmtime(os.path.join(self.directory, f))
+        )
+        for metadata_file in metadata_files:
+            with open(os.path.join(self.directory, metadata_file)) as f:
+                entry = json.load(f)
+            if all(os.path.exists(self.path(f)) for f in entry["files"].values()):
+                self.entries[entry["key"]] = entry
+        self.evict()
+
+    def key(self, *parts):
+        return hashlib.sha256(
+            ":".join(str(part) for part in parts).encode()
+        ).hexdigest()[:32]
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def size(self):
+        return sum(entry["bytes"] for entry in self.entries.values())
+
+    def get(self, key, directory=None):
+        # With a directory, the entry's files are linked into it under the
+        # lock, so an eviction cannot delete them before they are linked.
+        # An entry whose files are gone counts as a miss.
+        with self.lock:
+            entry = self.entries.get(key)
+            try:
+                if entry is None:
+                    raise FileNotFoundError(key)
+                if directory is not None:
+                    for filename in entry["files"].values():
+                        link_or_copy(
+                            self.path(filename), os.path.join(directory, filename)
+                        )
+                os.utime(self.path(f"{key}.json"))
+            except FileNotFoundError:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry["compute_seconds"]
+        return entry
+
+    def put(self, key, files, compute_seconds):
+        # files maps a name for each file of the entry to a file to move in,
+        # compute_seconds is what producing them cost
+        entry = {
+            "key": key,
+            "files": {},
+            "bytes": 0,
+            "compute_seconds": compute_seconds,
+        }
+        for name, source in files.items():
+            extension = os.path.splitext(source)[1]
+            filename = f"{key}_{name}{extension}"
+            shutil.move(source, self.path(filename))
+            entry["files"][name] = filename
+            entry["bytes"] += os.path.getsize(self.path(filename))
+
+        with open(self.path(f"{key}.json"), "w") as f:
+            json.dump(entry, f)
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.entries and self.size() > self.max_bytes:
+                key, entry = self.entries.popitem(last=False)
+                for filename in list(entry["files"].values()) + [f"{key}.json"]:
+                    if os.path.exists(self.path(filename)):
+                        os.remove(self.path(filename))
+                print(f"Evicted {self.name} {key}")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "saved_seconds": self.saved_seconds,
+            }
@@ -0,0 +1,157 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+READ_SIZE = 16 * 1024 * 1024
+
+
+def available_memory():
+    # MemAvailable from /proc/meminfo, None where there is no procfs
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class CheckpointPrefetcher:
+    # Reads checkpoints into the page cache on a background thread, so the
+    # first CheckpointLoaderSimple that needs one reads memory instead of
+    # disk. The files prefetched stay under a byte budget. The least
+    # recently prefetched are dropped from the cache to make room.
+    # Each checkpoint load is recorded as a hit (prefetch finished first), a
+    # partial (prefetch still running) or a miss, with its loader time.
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.in_progress = None
+        # Path to size, least recently prefetched first
+        self.prefetched = collections.OrderedDict()
+        self.names = {}
+        self.prefetch_seconds = 0.0
+        self.prefetch_bytes = 0
+        self.skipped = 0
+        self.loads = collections.defaultdict(list)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def prefetch(self, name, path, ready=None, evict=True):
+        # ready is a future to wait on first, such as the weight's download.
+        # Without evict the file is skipped if it does not fit the budget,
+        # so a list in order of priority fills the budget with the first.
+        with self.lock:
+            self.names[name] = path
+            if path in self.pending or os.path.realpath(path) in self.prefetched:
+                return
+            self.pending.add(path)
+        self.queue.put((name, path, ready, evict))
+
+    def run(self):
+        while True:
+            name, path, ready, evict = self.queue.get()
+            try:
+                if ready is not None:
+                    ready.result()
+                self.warm(name, path, evict)
+            except Exception as e:
+                print(f"Could not prefetch {name}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(path)
+                    self.in_progress = None
+
+    def make_room(self, size, evict):
+        # Called with the lock held
+        used = sum(self.prefetched.values())
+        while evict and self.prefetched and used + size > self.budget_bytes:
+            path, evicted_size = self.prefetched.popitem(last=False)
+            used -= evicted_size
+            self.advise(path, "POSIX_FADV_DONTNEED")
+        return used + size <= self.budget_bytes
+
+    def advise(self, path, advice):
+        if not hasattr(os, "posix_fadvise"):
+            return
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        finally:
+            os.close(fd)
+
+    def warm(self, name, link, evict=True):
+        # Resolve weights-store links so that the budget counts blobs once
+        path = os.path.realpath(link)
+        size = os.path.getsize(path)
+        with self.lock:
+            if not self.make_room(size, evict):
+                self.skipped += 1
+                print(f"Not prefetching {name}, it does not fit the budget")
+                return
+            self.in_progress = link
+
+        start = time.time()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # Queue the whole file for readahead, then read it through so it
+            # is resident when this returns
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            buffer = bytearray(READ_SIZE)
+            with open(fd, "rb", buffering=0, closefd=False) as f:
+                while f.readinto(buffer):
+                    pass
+        finally:
+            os.close(fd)
+        seconds = time.time() - start
+
+        with self.lock:
+            self.prefetched[path] = size
+            self.prefetch_seconds += seconds
+            self.prefetch_bytes += size
+        print(
+            f"Prefetched {name} in {seconds:.2f}s, {size / (1024 * 1024) / max(seconds, 1e-6):.2f}MB/s"
+        )
+
+    def record_load(self, name, seconds):
+        link = self.names.get(name)
+        path = os.path.realpath(link) if link else None
+        with self.lock:
+            if path in self.prefetched:
+                self.prefetched.move_to_end(path)
+                kind = "hit"
+            elif link is not None and (
+                link == self.in_progress or link in self.pending
+            ):
+                kind = "partial"
+            else:
+                kind = "miss"
+            self.loads[kind].append(seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "prefetched": len(self.prefetched),
+                "prefetched_bytes": sum(self.prefetched.values()),
+                "prefetch_mb_s": round(
+                    self.prefetch_bytes
+                    / (1024 * 1024)
+                    / max(self.prefetch_seconds, 1e-6),
+                    2,
+                ),
+                "skipped": self.skipped,
+                "loads": {
+                    kind: {
+                        "count": len(seconds),
+                        "mean_seconds": round(sum(seconds) / len(seconds), 3),
+                    }
+                    for kind, seconds in self.loads.items()
+                },
+            }
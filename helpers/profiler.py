@@ -0,0 +1,320 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Chrome trace rows, one per kind of span
+TRACE_THREADS = {"phase": 1, "node": 2, "step": 3}
+
+
+class PromptTrace:
+    # Timeline of one prompt, built from the bridge's websocket messages.
+    # A node runs from its executing message until the next one, and a
+    # sampler step from the previous progress message (or the node start).
+    def __init__(self, prompt_id, workflow, labels=None):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.labels = dict(labels or {})
+        self.started_at = time.time()
+        self.finished_at = None
+        self.spans = []
+        self.open_phases = {}
+        self.node_timings = {}
+        self.nodes = []
+        self.steps = []
+        self.cached_nodes = []
+        self.bridge_timings = {}
+        self.current_node = None
+        self.current_node_start = None
+        self.current_step_start = None
+
+    def node_info(self, node_id):
+        # get() reads the node without copying it out of a template overlay
+        node = self.workflow.get(node_id, {})
+        return (
+            node.get("class_type", "Unknown"),
+            node.get("_meta", {}).get("title", "Unknown"),
+        )
+
+    def add_span(self, name, category, start, end, args=None):
+        self.spans.append((name, category, start, end, args or {}))
+
+    def begin(self, phase):
+        self.open_phases[phase] = time.time()
+
+    def end(self, phase):
+        start = self.open_phases.pop(phase, None)
+        if start is not None:
+            self.add_span(phase, "phase", start, time.time())
+
+    def enter_node(self, node_id):
+        # None marks the end of the prompt
+        now = time.time()
+        self.end("queue_wait")
+        if self.current_node is not None:
+            seconds = now - self.current_node_start
+            class_type, title = self.node_info(self.current_node)
+            self.node_timings[self.current_node] = seconds
+            self.nodes.append(
+                {
+                    "node_id": self.current_node,
+                    "class_type": class_type,
+                    "title": title,
+                    "seconds": seconds,
+                    "steps": sum(
+                        1 for step in self.steps if step["node_id"] == self.current_node
+                    ),
+                }
+            )
+            self.add_span(
+                class_type,
+                "node",
+                self.current_node_start,
+                now,
+                {"node_id": self.current_node, "title": title},
+            )
+        self.current_node = node_id
+        self.current_node_start = now
+        self.current_step_start = now
+
+    def step(self, value, max_value, node_id=None):
+        now = time.time()
+        node_id = node_id or self.current_node
+        start = self.current_step_start or now
+        self.steps.append(
+            {"node_id": node_id, "step": value, "of": max_value, "seconds": now - start}
+        )
+        self.add_span(
+            f"step {value}/{max_value}", "step", start, now, {"node_id": node_id}
+        )
+        self.current_step_start = now
+
+    def cached(self, node_ids):
+        for node_id in node_ids:
+            class_type, title = self.node_info(node_id)
+            self.cached_nodes.append(
+                {"node_id": node_id, "class_type": class_type, "title": title}
+            )
+
+    def finish(self):
+        for phase in list(self.open_phases):
+            self.end(phase)
+        self.finished_at = time.time()
+
+    def phase_seconds(self, phase):
+        return sum(
+            end - start
+            for name, category, start, end, _ in self.spans
+            if category == "phase" and name == phase
+        )
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        return {
+            "prompt_id": self.prompt_id,
+            "labels": self.labels,
+            "total_seconds": finished_at - self.started_at,
+            "queue_wait_seconds": self.phase_seconds("queue_wait"),
+            "output_collection_seconds": self.phase_seconds("output_collection"),
+            "nodes": self.nodes,
+            "cached_nodes": self.cached_nodes,
+            "steps": self.steps,
+            "bridge_seconds": self.bridge_timings,
+        }
+
+    def to_chrome_trace(self):
+        # Loads in chrome://tracing and Perfetto. Times are in microseconds
+        # from the start of the prompt.
+        name = " ".join(f"{k}={v}" for k, v in self.labels.items())
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": 1,
+                "args": {"name": f"prompt {self.prompt_id} {name}".strip()},
+            }
+        ]
+        for category, tid in TRACE_THREADS.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": 1,
+                    "tid": tid,
+                    "args": {"name": category},
+                }
+            )
+
+        for name, category, start, end, args in self.spans:
+            events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.started_at) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": 1,
+                    "tid": TRACE_THREADS[category],
+                    "args": args,
+                }
+            )
+        for node in self.cached_nodes:
+            events.append(
+                {
+                    "name": f"{node['class_type']} (cached)",
+                    "cat": "node",
+                    "ph": "i",
+                    "s": "t",
+                    "ts": 0,
+                    "pid": 1,
+                    "tid": TRACE_THREADS["node"],
+                    "args": node,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.prompt_id}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+        with open(os.path.join(directory, f"{self.prompt_id}.trace.json"), "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        return path
+
+    def report(self):
+        profile = self.to_dict()
+        nodes = sorted(profile["nodes"], key=lambda n: n["seconds"], reverse=True)
+        parts = [
+            f"total {profile['total_seconds']:.2f}s",
+            f"queue wait {profile['queue_wait_seconds']:.3f}s",
+            f"output collection {profile['output_collection_seconds']:.3f}s",
+        ]
+        for node in nodes:
+            part = f"{node['class_type']} ({node['node_id']}) {node['seconds']:.2f}s"
+            if node["steps"]:
+                part += f", {node['seconds'] / node['steps']:.3f}s/step"
+            parts.append(part)
+        print("Profile: " + ", ".join(parts))
+
+
+class ProfileStats:
+    # Mean seconds per node class type across traces that share a label,
+    # to compare where time goes for each preset
+    def __init__(self, label):
+        self.label = label
+        self.lock = threading.Lock()
+        self.runs = collections.Counter()
+        self.seconds = collections.defaultdict(collections.Counter)
+
+    def add(self, trace):
+        key = trace.labels.get(self.label)
+        with self.lock:
+            self.runs[key] += 1
+            for node in trace.nodes:
+                self.seconds[key][node["class_type"]] += node["seconds"]
+
+    def stats(self):
+        with self.lock:
+            return {
+                key: {
+                    class_type: seconds / self.runs[key]
+                    for class_type, seconds in self.seconds[key].most_common()
+                }
+                for key in self.runs
+            }
+
+
+class BootTrace:
+    # Timeline of Predictor.setup. Each span has a row, one per line of work
+    # that runs alongside the others, so phases that overlap show side by
+    # side. Spans can also be added afterwards from recorded times, such as
+    # each server's boot.
+    def __init__(self, started_at=None):
+        self.started_at = started_at or time.time()
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add_span(self, name, row, start, end):
+        with self.lock:
+            self.spans.append((name, row, start, end))
+
+    @contextlib.contextmanager
+    def phase(self, name, row="setup"):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_span(name, row, start, time.time())
+
+    def run(self, name, row, fn, *args):
+        # For phases handed to another thread
+        with self.phase(name, row):
+            return fn(*args)
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span[2])
+        return {
+            "total_seconds": max((end for *_, end in spans), default=self.started_at)
+            - self.started_at,
+            "spans": [
+                {
+                    "name": name,
+                    "row": row,
+                    "start_seconds": start - self.started_at,
+                    "seconds": end - start,
+                }
+                for name, row, start, end in spans
+            ],
+        }
+
+    def to_chrome_trace(self):
+        rows = {}
+        events = [
+            {"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "setup"}}
+        ]
+        for span in self.to_dict()["spans"]:
+            if span["row"] not in rows:
+                rows[span["row"]] = len(rows) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": 1,
+                        "tid": rows[span["row"]],
+                        "args": {"name": span["row"]},
+                    }
+                )
+            events.append(
+                {
+                    "name": span["name"],
+                    "cat": span["row"],
+                    "ph": "X",
+                    "ts": span["start_seconds"] * 1e6,
+                    "dur": span["seconds"] * 1e6,
+                    "pid": 1,
+                    "tid": rows[span["row"]],
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "boot.json")
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+        with open(os.path.join(directory, "boot.trace.json"), "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        return path
+
+    def report(self):
+        profile = self.to_dict()
+        parts = [f"total {profile['total_seconds']:.2f}s"]
+        for span in profile["spans"]:
+            parts.append(
+                f"{span['row']}/{span['name']} at {span['start_seconds']:.2f}s for {span['seconds']:.2f}s"
+            )
+        print("Boot: " + ", ".join(parts))
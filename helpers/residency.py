@@ -0,0 +1,107 @@
+import collections
+import threading
+import time
+
+# Weight of earlier requests in a checkpoint's popularity, per request
+POPULARITY_DECAY = 0.95
+
+
+class CheckpointResidency:
+    # Which checkpoints each worker holds in VRAM, so requests can go to a
+    # worker that already has theirs loaded.
+    # ComfyUI's /free unloads every model at once rather than one of them.
+    # Once a worker holds as many checkpoints as capacity allows and a new
+    # one is needed, it is freed entirely before the load. This keeps
+    # ComfyUI from partially offloading the old weights to make room. The
+    # pool sends a switch to the worker whose checkpoints are least
+    # popular, so the popular ones stay resident elsewhere.
+    def __init__(self, capacity=1):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        # Worker index to its checkpoints, least recently used first
+        self.resident = collections.defaultdict(collections.OrderedDict)
+        # Worker index to the checkpoint its last prompt used
+        self.last_used = {}
+        self.popularity = collections.Counter()
+        self.loads = collections.Counter()
+        self.switches = collections.Counter()
+        self.switch_seconds = collections.Counter()
+        self.frees = 0
+
+    def requested(self, ckpt_name):
+        with self.lock:
+            for name in self.popularity:
+                self.popularity[name] *= POPULARITY_DECAY
+            self.popularity[ckpt_name] += 1
+
+    def is_resident(self, worker, ckpt_name):
+        return ckpt_name in self.resident[worker.index]
+
+    def holds_any(self, worker, ckpt_names):
+        return any(name in self.resident[worker.index] for name in ckpt_names)
+
+    def eviction_cost(self, worker):
+        # Popularity of what loading another checkpoint would unload
+        resident = self.resident[worker.index]
+        if len(resident) < self.capacity:
+            return 0.0
+        return sum(self.popularity[name] for name in resident)
+
+    def prepare(self, worker, ckpt_name):
+        # Called while holding the worker, before its prompt is queued
+        with self.lock:
+            resident = self.resident[worker.index]
+            evicted = []
+            if ckpt_name not in resident and len(resident) >= self.capacity:
+                evicted = list(resident)
+                resident.clear()
+                self.frees += 1
+            # Counted as loaded from now on, so that prompts for the same
+            # checkpoint can queue on the worker behind this one
+            resident[ckpt_name] = time.time()
+            resident.move_to_end(ckpt_name)
+        if evicted:
+            print(f"Worker {worker.index}: unloading {', '.join(evicted)}")
+            worker.comfyUI.free_memory()
+
+    def record(self, worker, ckpt_name, load_seconds=None):
+        # load_seconds is the loader node's time, None if ComfyUI cached it
+        with self.lock:
+            resident = self.resident[worker.index]
+            previous = self.last_used.get(worker.index)
+            if load_seconds is not None:
+                self.loads[ckpt_name] += 1
+                # The first load on a worker is a cold start, not a switch
+                if previous not in [None, ckpt_name]:
+                    self.switches[ckpt_name] += 1
+                    self.switch_seconds[ckpt_name] += load_seconds
+            self.last_used[worker.index] = ckpt_name
+            resident[ckpt_name] = time.time()
+            resident.move_to_end(ckpt_name)
+            while len(resident) > self.capacity:
+                resident.popitem(last=False)
+
+    def forget(self, worker):
+        # The worker's server restarted with nothing loaded
+        with self.lock:
+            self.resident.pop(worker.index, None)
+            self.last_used.pop(worker.index, None)
+
+    def stats(self):
+        with self.lock:
+            switches = sum(self.switches.values())
+            switch_seconds = sum(self.switch_seconds.values())
+            return {
+                "capacity": self.capacity,
+                "resident": {
+                    index: list(resident) for index, resident in self.resident.items()
+                },
+                "loads": sum(self.loads.values()),
+                "switches": switches,
+                "switch_seconds": round(switch_seconds, 3),
+                "mean_switch_seconds": (
+                    round(switch_seconds / switches, 3) if switches else 0.0
+                ),
+                "frees": self.frees,
+                "switches_by_checkpoint": dict(self.switches),
+            }
@@ -0,0 +1,148 @@
+import json
+import threading
+import time
+
+# Readiness of each preset, in the order a preset moves through them
+COLD = "cold"
+DOWNLOADING = "downloading"
+DOWNLOADED = "downloaded"
+LOADED = "loaded"
+FAILED = "failed"
+
+
+def checkpoint_warmup_workflow(ckpt_name):
+    # The smallest graph that makes ComfyUI load a checkpoint: an output node
+    # is needed or nothing executes, so sample a single step at 64x64
+    return {
+        "1": {
+            "inputs": {"ckpt_name": ckpt_name},
+            "class_type": "CheckpointLoaderSimple",
+        },
+        "2": {
+            "inputs": {"text": "", "clip": ["1", 1]},
+            "class_type": "CLIPTextEncode",
+        },
+        "3": {
+            "inputs": {"width": 64, "height": 64, "batch_size": 1},
+            "class_type": "EmptyLatentImage",
+        },
+        "4": {
+            "inputs": {
+                "seed": 0,
+                "steps": 1,
+                "cfg": 1,
+                "sampler_name": "euler",
+                "scheduler": "normal",
+                "denoise": 1,
+                "model": ["1", 0],
+                "positive": ["2", 0],
+                "negative": ["2", 0],
+                "latent_image": ["3", 0],
+            },
+            "class_type": "KSampler",
+        },
+        "5": {
+            "inputs": {"samples": ["4", 0], "vae": ["1", 2]},
+            "class_type": "VAEDecode",
+        },
+        "6": {
+            "inputs": {"images": ["5", 0]},
+            "class_type": "PreviewImage",
+        },
+    }
+
+
+class PresetWarmer:
+    def __init__(
+        self,
+        pool,
+        presets,
+        load_checkpoints=False,
+        status_file=None,
+    ):
+        # presets maps a preset name to the workflows it can run
+        self.pool = pool
+        self.presets = presets
+        self.load_checkpoints = load_checkpoints
+        self.status_file = status_file
+        self.status = {preset: COLD for preset in presets}
+        self.status_lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.write_status()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def is_ready(self, preset):
+        return self.status.get(preset) in [DOWNLOADED, LOADED]
+
+    def set_status(self, preset, status):
+        with self.status_lock:
+            self.status[preset] = status
+            self.write_status()
+        print(f"🔥 Preset {preset}: {status}")
+
+    def write_status(self):
+        if self.status_file:
+            with open(self.status_file, "w") as f:
+                json.dump(self.status, f)
+
+    def run(self):
+        start = time.time()
+
+        # Queue every preset's weights before waiting on any of them, so the
+        # download pool stays busy while earlier presets finish
+        # Workers share the models directory and the downloader
+        comfyUI = self.pool.primary.comfyUI
+        plans = {}
+        for preset, workflows in self.presets.items():
+            plans[preset] = [
+                comfyUI.handle_weights(workflow, wait=False) for workflow in workflows
+            ]
+            self.set_status(preset, DOWNLOADING)
+
+        for preset, preset_plans in plans.items():
+            try:
+                for plan in preset_plans:
+                    comfyUI.wait_for_weights(plan)
+            except Exception as e:
+                print(f"❌ Error warming up preset {preset}: {e}")
+                self.set_status(preset, FAILED)
+                continue
+            self.set_status(preset, DOWNLOADED)
+
+            if self.load_checkpoints:
+                self.load_checkpoint(preset)
+
+        print(f"🔥 Warm-up finished in {time.time() - start:.2f}s: {self.status}")
+
+    def load_checkpoint(self, preset):
+        ckpt_names = {
+            node["inputs"]["ckpt_name"]
+            for workflow in self.presets[preset]
+            for node in workflow.values()
+            if node.get("class_type") == "CheckpointLoaderSimple"
+        }
+
+        try:
+            # The pool routes each checkpoint to a worker as it would a
+            # request, so presets spread over workers instead of evicting
+            # each other. Holding the worker keeps a warm-up prompt from
+            # sharing the server or the websocket with a real request.
+            for ckpt_name in ckpt_names:
+                with self.pool.acquire(ckpt_name=ckpt_name, exclusive=True) as worker:
+                    if self.pool.residency:
+                        self.pool.residency.prepare(worker, ckpt_name)
+                    worker.comfyUI.connect()
+                    worker.comfyUI.run_workflow(checkpoint_warmup_workflow(ckpt_name))
+                    if self.pool.residency:
+                        self.pool.residency.record(
+                            worker,
+                            ckpt_name,
+                            worker.comfyUI.trace.node_timings.get("1"),
+                        )
+        except Exception as e:
+            print(f"❌ Error loading checkpoint for preset {preset}: {e}")
+            return
+        self.set_status(preset, LOADED)
@@ -0,0 +1,336 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+# Worker states
+STARTING = "starting"
+READY = "ready"
+DRAINING = "draining"
+STOPPED = "stopped"
+FAILED = "failed"
+
+MONITOR_INTERVAL = 1.0
+MAX_RESTARTS = 3
+# Longest a request leaves an idle worker to a later request that has the
+# worker's checkpoint loaded, before switching the worker's checkpoint itself
+AFFINITY_WAIT = 2.0
+# Prompts a worker takes at once. ComfyUI runs them one after the other,
+# but the next one is already queued when the last finishes.
+PROMPTS_PER_WORKER = 2
+
+
+class Worker:
+    # One ComfyUI server with its own port and output directory. The pool
+    # hands it to up to capacity requests at once, whose prompts queue on
+    # the server, or to one request that holds it exclusively.
+    def __init__(
+        self,
+        index,
+        comfyUI,
+        output_directory,
+        input_directory,
+        external,
+        capacity=PROMPTS_PER_WORKER,
+    ):
+        self.index = index
+        self.comfyUI = comfyUI
+        self.output_directory = output_directory
+        self.input_directory = input_directory
+        self.external = external
+        self.capacity = capacity
+        self.state = STARTING
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.exclusive = False
+        self.busy_since = None
+        self.busy_seconds = 0.0
+        self.requests = 0
+        self.restarts = 0
+        self.started_at = time.time()
+
+    def start(self):
+        self.state = STARTING
+        if self.external:
+            self.comfyUI.use_running_server(self.output_directory, self.input_directory)
+        else:
+            self.comfyUI.start_server(self.output_directory, self.input_directory)
+        self.started_at = time.time()
+        self.state = READY
+
+    @property
+    def busy(self):
+        return self.in_flight > 0
+
+    def can_take(self, exclusive=False):
+        if self.state != READY or self.exclusive:
+            return False
+        if exclusive:
+            return self.in_flight == 0
+        return self.in_flight < self.capacity
+
+    def has_crashed(self):
+        if self.external or self.state != READY:
+            return False
+        return self.comfyUI.server_process.poll() is not None
+
+    def utilisation(self):
+        busy_seconds = self.busy_seconds
+        if self.busy:
+            busy_seconds += time.time() - self.busy_since
+        uptime = time.time() - self.started_at
+        return busy_seconds / uptime if uptime else 0.0
+
+    def stats(self):
+        return {
+            "index": self.index,
+            "address": self.comfyUI.server_address,
+            "state": self.state,
+            "busy": self.busy,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests,
+            "restarts": self.restarts,
+            "utilisation": round(self.utilisation(), 3),
+        }
+
+
+class Waiter:
+    def __init__(self, ckpt_name, exclusive=False):
+        self.ckpt_name = ckpt_name
+        self.exclusive = exclusive
+        self.since = time.time()
+        # The worker an exclusive waiter waits to drain
+        self.claimed = None
+
+
+class WorkerPool:
+    # Hands each request the idle worker that has been busy for the least
+    # time, and restarts workers whose server process exits. A worker takes
+    # up to its capacity of requests at once, so the next prompt is queued
+    # on the server before the last one finishes.
+    # With a CheckpointResidency, requests go to a worker that has their
+    # checkpoint loaded when one is idle. Otherwise they are reordered so a
+    # waiting request whose checkpoint an idle worker holds goes first.
+    # A request that needs a worker to itself claims one while it waits, and
+    # no other request is handed that worker until it has drained.
+    # make_worker(index) returns a Worker that has not been started.
+    def __init__(self, size, make_worker, residency=None):
+        self.workers = [make_worker(index) for index in range(size)]
+        self.residency = residency
+        self.condition = threading.Condition()
+        self.waiters = []
+        self.monitor_thread = None
+
+    def start(self):
+        # Servers import in parallel, the slowest one sets the setup time
+        errors = []
+
+        def start_worker(worker):
+            try:
+                worker.start()
+            except Exception as e:
+                worker.state = FAILED
+                errors.append(e)
+                print(f"❌ Worker {worker.index} failed to start: {e}")
+
+        threads = [
+            threading.Thread(target=start_worker, args=(worker,))
+            for worker in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(errors) == len(self.workers):
+            raise errors[0]
+
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+        print(f"Workers: {self.stats()}")
+
+    @property
+    def primary(self):
+        # For work that any server can do, such as resolving weights, which
+        # every worker shares
+        return self.workers[0]
+
+    def is_claimed(self, worker, waiter):
+        return any(w.claimed is worker for w in self.waiters if w is not waiter)
+
+    def claim(self, worker, waiter):
+        # Keeps its claim while that worker runs, otherwise claims the given
+        # worker, or the one with its checkpoint and the fewest prompts
+        if waiter.claimed is not None and waiter.claimed.state == READY:
+            return waiter.claimed
+        candidates = [
+            w
+            for w in ([worker] if worker else self.workers)
+            if w.state == READY and not self.is_claimed(w, waiter)
+        ]
+        if self.residency and waiter.ckpt_name:
+            warm = [
+                w for w in candidates if self.residency.is_resident(w, waiter.ckpt_name)
+            ]
+            candidates = warm or candidates
+        return min(
+            candidates, key=lambda w: (w.in_flight, w.utilisation()), default=None
+        )
+
+    def choose(self, worker, waiter):
+        if worker is not None:
+            if self.is_claimed(worker, waiter):
+                return None
+            return worker if worker.can_take(waiter.exclusive) else None
+        idle = [
+            w
+            for w in self.workers
+            if w.can_take(waiter.exclusive) and not self.is_claimed(w, waiter)
+        ]
+        if not idle or not self.residency or not waiter.ckpt_name:
+            return min(idle, key=lambda w: (w.in_flight, w.utilisation()), default=None)
+
+        warm = [w for w in idle if self.residency.is_resident(w, waiter.ckpt_name)]
+        if warm:
+            return min(warm, key=lambda w: (w.in_flight, w.utilisation()))
+
+        # A prompt only queues behind others on a server that has its
+        # checkpoint, switching happens on a server with nothing queued
+        idle = [w for w in idle if not w.busy]
+
+        if time.time() - waiter.since < AFFINITY_WAIT:
+            wanted = {w.ckpt_name for w in self.waiters if w is not waiter}
+            idle = [w for w in idle if not self.residency.holds_any(w, wanted)]
+        # Switch the worker whose checkpoints are least worth keeping
+        return min(
+            idle,
+            key=lambda w: (self.residency.eviction_cost(w), w.utilisation()),
+            default=None,
+        )
+
+    @contextlib.contextmanager
+    def acquire(self, worker=None, ckpt_name=None, exclusive=False):
+        # Waits until a worker can take another prompt, or the given one can,
+        # and holds it. An exclusive hold waits for the worker to be idle and
+        # keeps every other request off it, such as for the sync client.
+        waiter = Waiter(ckpt_name, exclusive)
+        if self.residency and ckpt_name:
+            self.residency.requested(ckpt_name)
+        with self.condition:
+            self.waiters.append(waiter)
+            try:
+                while True:
+                    chosen = self.choose(worker, waiter)
+                    if chosen:
+                        break
+                    candidates = [worker] if worker else self.workers
+                    if not any(w.state in [READY, STARTING] for w in candidates):
+                        raise RuntimeError("No ComfyUI workers are available")
+                    if exclusive:
+                        # Otherwise requests that share workers keep taking
+                        # each one before it is ever idle
+                        waiter.claimed = self.claim(worker, waiter)
+                    # Wakes up to stop deferring to other waiters once it
+                    # has waited AFFINITY_WAIT
+                    self.condition.wait(AFFINITY_WAIT if self.residency else None)
+            finally:
+                self.waiters.remove(waiter)
+                # Waiters that deferred to this one can take its worker
+                self.condition.notify_all()
+            if not chosen.busy:
+                chosen.busy_since = time.time()
+            chosen.in_flight += 1
+            chosen.peak_in_flight = max(chosen.peak_in_flight, chosen.in_flight)
+            chosen.exclusive = exclusive
+
+        try:
+            yield chosen
+        finally:
+            with self.condition:
+                chosen.in_flight -= 1
+                chosen.exclusive = False
+                if not chosen.busy:
+                    chosen.busy_seconds += time.time() - chosen.busy_since
+                chosen.requests += 1
+                self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def acquire_async(self, worker=None, ckpt_name=None, exclusive=False):
+        # acquire() for coroutines. The wait runs on a thread, so the event
+        # loop keeps serving other predictions in the meantime.
+        manager = self.acquire(worker, ckpt_name, exclusive)
+        entering = asyncio.ensure_future(asyncio.to_thread(manager.__enter__))
+
+        def release(future):
+            if not future.cancelled() and future.exception() is None:
+                manager.__exit__(None, None, None)
+
+        try:
+            chosen = await asyncio.shield(entering)
+        except asyncio.CancelledError:
+            # The thread still gets its worker, so hand it straight back
+            entering.add_done_callback(release)
+            raise
+        try:
+            yield chosen
+        finally:
+            manager.__exit__(None, None, None)
+
+    def monitor(self):
+        while True:
+            time.sleep(MONITOR_INTERVAL)
+            for worker in self.workers:
+                if worker.has_crashed():
+                    self.restart(worker)
+
+    def restart(self, worker):
+        exit_code = worker.comfyUI.server_process.poll()
+        print(f"❌ Worker {worker.index} exited with code {exit_code}, restarting")
+        with self.condition:
+            worker.state = STARTING
+        worker.comfyUI.close()
+        if self.residency:
+            self.residency.forget(worker)
+
+        while worker.restarts < MAX_RESTARTS:
+            worker.restarts += 1
+            try:
+                worker.start()
+                break
+            except Exception as e:
+                print(f"❌ Worker {worker.index} failed to restart: {e}")
+        else:
+            worker.state = FAILED
+
+        with self.condition:
+            self.condition.notify_all()
+        print(f"Workers: {self.stats()}")
+
+    def drain(self, worker, timeout=None):
+        # Stops new requests reaching the worker, waits for its current one
+        # and then stops its server
+        with self.condition:
+            worker.state = DRAINING
+            self.condition.wait_for(lambda: not worker.busy, timeout)
+            worker.state = STOPPED
+            self.condition.notify_all()
+        if not worker.external:
+            worker.comfyUI.stop_server()
+        print(f"Drained worker {worker.index}")
+
+    def close(self, timeout=None):
+        for worker in self.workers:
+            if worker.state not in [STOPPED, FAILED]:
+                self.drain(worker, timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "size": len(self.workers),
+                "ready": sum(1 for w in self.workers if w.state == READY),
+                "busy": sum(1 for w in self.workers if w.busy),
+                "waiting": len(self.waiters),
+                "workers": [worker.stats() for worker in self.workers],
+                "checkpoints": self.residency.stats() if self.residency else None,
+            }
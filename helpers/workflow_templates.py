@@ -0,0 +1,91 @@
+import json
+import threading
+
+# Node class types that requests patch, so callers can find them by role
+# rather than by the node ids of a particular template
+SLOT_CLASS_TYPES = {
+    "loader": ["CheckpointLoaderSimple"],
+    "sampler": ["KSampler"],
+    "latent": ["EmptyLatentImage", "RepeatLatentBatch"],
+    "controlnet": ["ControlNetApply"],
+}
+
+
+class WorkflowOverlay(dict):
+    # A copy-on-write view of a template. Nodes are shared with the template
+    # until they are looked up by id, which copies that node and its inputs.
+    # Iterating values() returns shared nodes, so only read them that way.
+    def __init__(self, template):
+        super().__init__(template.workflow)
+        self.template = template
+        self.slots = template.slots
+        self.patched = set()
+
+    def __getitem__(self, node_id):
+        node = super().__getitem__(node_id)
+        if node_id not in self.patched:
+            node = {**node, "inputs": dict(node.get("inputs", {}))}
+            super().__setitem__(node_id, node)
+            self.patched.add(node_id)
+        return node
+
+    def __setitem__(self, node_id, node):
+        super().__setitem__(node_id, node)
+        self.patched.add(node_id)
+
+    def is_shared(self, node_id):
+        return node_id not in self.patched
+
+    def to_json(self):
+        # Unpatched nodes reuse the JSON serialised when the template loaded
+        return (
+            "{"
+            + ", ".join(
+                f"{json.dumps(node_id)}: "
+                + (
+                    self.template.node_json[node_id]
+                    if self.is_shared(node_id)
+                    else json.dumps(node)
+                )
+                for node_id, node in self.items()
+            )
+            + "}"
+        )
+
+
+class WorkflowTemplate:
+    def __init__(self, path):
+        with open(path, "r") as file:
+            self.workflow = json.load(file)
+
+        self.node_json = {
+            node_id: json.dumps(node) for node_id, node in self.workflow.items()
+        }
+        self.slots = {}
+        for node_id, node in self.workflow.items():
+            for slot, class_types in SLOT_CLASS_TYPES.items():
+                if node.get("class_type") in class_types and slot not in self.slots:
+                    self.slots[slot] = node_id
+        self.weights_by_node = {}
+
+    def overlay(self):
+        return WorkflowOverlay(self)
+
+    def node_weights(self, node_id, resolve):
+        # Weights of an unpatched node never change, resolve them once
+        if node_id not in self.weights_by_node:
+            self.weights_by_node[node_id] = resolve(self.workflow[node_id])
+        return self.weights_by_node[node_id]
+
+
+class WorkflowTemplates:
+    # Parses each workflow file once, on first use
+    def __init__(self):
+        self.templates = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            if path not in self.templates:
+                self.templates[path] = WorkflowTemplate(path)
+            return self.templates[path]
@@ -1,62 +1,634 @@
+import time
+
+# Start of the module's imports, the first phase of the boot trace
+IMPORTS_STARTED_AT = time.time()
+
 import os
+import asyncio
+import collections
+import functools
+import glob
+import hashlib
+import importlib
 import shutil
-import json
 import mimetypes
 import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from typing import List
+from typing import AsyncIterator
 from cog import BasePredictor, Input, Path
+from helpers.batcher import MicroBatcher
 from helpers.comfyui import ComfyUI
+from helpers.file_cache import FileCache, link_or_copy
+from helpers.prefetch import CheckpointPrefetcher, available_memory
+from helpers.profiler import BootTrace, ProfileStats
+from helpers.residency import CheckpointResidency
+from helpers.warmup import PresetWarmer
+from helpers.worker_pool import Worker, WorkerPool
+from helpers.workflow_templates import WorkflowTemplates
+from weights_downloader import WeightsDownloader
 
-OUTPUT_DIR = "/tmp/outputs"
-INPUT_DIR = "/tmp/inputs"
+IMPORTS_FINISHED_AT = time.time()
+
+# Inputs, outputs and caches live under here, such as a benchmark's own
+# workspace so runs do not share state
+TMP_DIR = os.environ.get("TMP_DIR", "/tmp")
+OUTPUT_DIR = os.path.join(TMP_DIR, "outputs")
+INPUT_DIR = os.path.join(TMP_DIR, "inputs")
+COMFYUI_OUTPUT_DIR = os.path.join(TMP_DIR, "comfyui_outputs")
 COMFYUI_TEMP_OUTPUT_DIR = "ComfyUI/temp"
+PRESET_READINESS_FILE = os.path.join(TMP_DIR, "preset_readiness.json")
+
+# Number of ComfyUI servers to run, on consecutive ports from the base port
+COMFYUI_WORKERS = int(os.environ.get("COMFYUI_WORKERS", "1"))
+COMFYUI_BASE_PORT = 8188
+# Comma separated CUDA devices that workers are spread over
+COMFYUI_CUDA_DEVICES = os.environ.get("COMFYUI_CUDA_DEVICES", "")
+# Comma separated addresses of already running servers to use instead of
+# starting ComfyUI. Each must use the directories of its worker_directories.
+COMFYUI_SERVER = os.environ.get("COMFYUI_SERVER", "")
+
+# Checkpoint of each model preset
+CHECKPOINTS = {
+    "fast": "dreamshaperXL_lightningDPMSDE.safetensors",
+    "high-quality": "albedobaseXL_v21.safetensors",
+    "realistic": "RealVisXL_V4.0.safetensors",
+    "cinematic": "CinematicRedmond.safetensors",
+    "animated": "starlightXLAnimated_v3.safetensors",
+}
+MODELS = list(CHECKPOINTS)
+# Checkpoints a ComfyUI server keeps in VRAM before it is freed for another.
+# ComfyUI's default cache only keeps the last prompt's checkpoint.
+RESIDENT_CHECKPOINTS = int(os.environ.get("RESIDENT_CHECKPOINTS", "1"))
+
+# Comma separated presets to download at setup, "all" or "none"
+WARMUP_PRESETS = os.environ.get("WARMUP_PRESETS", "all")
+# Also run a one step prompt per checkpoint so ComfyUI has it in memory
+WARMUP_LOAD_CHECKPOINTS = os.environ.get("WARMUP_LOAD_CHECKPOINTS", "") == "true"
+
+# Opt-in batching of concurrent unseeded requests that only differ in how
+# many images they want. 0 disables batching.
+BATCH_MAX_WAIT_MS = int(os.environ.get("BATCH_MAX_WAIT_MS", "0"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "16"))
+
+# Encoded style images are reused from here instead of running CLIP vision
+# again. 0 disables the cache.
+EMBEDS_CACHE_DIR = os.path.join(TMP_DIR, "cache", "ipadapter_embeds")
+EMBEDS_CACHE_MB = int(os.environ.get("EMBEDS_CACHE_MB", "1024"))
+EMBEDS_OUTPUT_SUBFOLDER = "ipadapter_embeds"
+
+# Depth maps of structure images, so repeat structure images skip the
+# preprocessor and its model. 0 disables the cache.
+DEPTH_CACHE_DIR = os.path.join(TMP_DIR, "cache", "depth_maps")
+DEPTH_CACHE_MB = int(os.environ.get("DEPTH_CACHE_MB", "512"))
+DEPTH_OUTPUT_SUBFOLDER = "depth_maps"
 
 mimetypes.add_type("image/webp", ".webp")
 
-with open("style-transfer-api.json", "r") as file:
-    STYLE_TRANSFER_WORKFLOW_JSON = file.read()
+# Uploads in these formats are handed to LoadImage as they are
+PASSTHROUGH_FORMATS = {"PNG": "png", "JPEG": "jpg", "WEBP": "webp"}
+INPUT_CACHE_MB = int(os.environ.get("INPUT_CACHE_MB", "1024"))
+# Pillow releases the GIL while encoding, so threads encode in parallel
+MAX_ENCODE_WORKERS = 10
+# A finished prediction's outputs are kept this long, cog may still be
+# reading or uploading them after the prediction's last yield
+OUTPUT_RETENTION_SECONDS = float(os.environ.get("OUTPUT_RETENTION_SECONDS", "600"))
+
+# Sampler previews sent by the server: none, auto, latent2rgb or taesd.
+# Off by default, they cost sampling time on every prompt. Once set, they
+# are only returned to callers that ask for them.
+PREVIEW_METHOD = os.environ.get("PREVIEW_METHOD", "none")
+
+# A prompt still running this many seconds after it started executing is
+# interrupted and the prediction fails. Time queued behind other prompts
+# does not count. 0 waits forever.
+PROMPT_TIMEOUT = float(os.environ.get("PROMPT_TIMEOUT", "300"))
+
+# Predictions the predictor runs at once, matching concurrency.max in
+# cog.yaml. Those beyond the pool's size wait for a free ComfyUI worker.
+MAX_CONCURRENT_PREDICTIONS = int(os.environ.get("MAX_CONCURRENT_PREDICTIONS", "4"))
+
+# Page cache to fill with checkpoints ahead of their first load. -1 uses
+# half of the memory available at setup, 0 disables prefetching.
+PREFETCH_MEMORY_GB = float(os.environ.get("PREFETCH_MEMORY_GB", "-1"))
+
+# Each prompt's profile is written here as JSON and as a Chrome trace
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "")
+
+STYLE_TRANSFER_WORKFLOW = "style-transfer-api.json"
+STYLE_TRANSFER_WITH_STRUCTURE_WORKFLOW = "style-transfer-with-structure-api.json"
 
-with open("style-transfer-with-structure-api.json", "r") as file:
-    STYLE_TRANSFER_WITH_STRUCTURE_WORKFLOW_JSON = file.read()
+workflow_templates = WorkflowTemplates()
+
+
+def worker_directories(index):
+    # Each server writes to its own output directory. Inputs are named by
+    # content, so every server reads from the same input directory and
+    # they are in place before the prediction knows which worker it gets.
+    return os.path.join(COMFYUI_OUTPUT_DIR, str(index)), INPUT_DIR
+
+
+def preset_workflows(preset):
+    # A preset needs the weights of both templates with its checkpoint
+    workflows = []
+    for path in [STYLE_TRANSFER_WORKFLOW, STYLE_TRANSFER_WITH_STRUCTURE_WORKFLOW]:
+        workflow = workflow_templates.get(path).overlay()
+        Predictor.set_weights(workflow, preset)
+        workflows.append(workflow)
+    return workflows
+
+
+@functools.lru_cache(maxsize=64)
+def file_hash(path, size, mtime):
+    # Size and mtime are part of the cache key so a changed file is rehashed
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 class Predictor(BasePredictor):
     def setup(self):
-        self.comfyUI = ComfyUI("127.0.0.1:8188")
-        self.comfyUI.start_server(OUTPUT_DIR, INPUT_DIR)
-        self.comfyUI.load_workflow(
-            STYLE_TRANSFER_WORKFLOW_JSON, handle_inputs=False, handle_weights=True
+        boot = self.boot = BootTrace(IMPORTS_STARTED_AT)
+        boot.add_span("imports", "setup", IMPORTS_STARTED_AT, IMPORTS_FINISHED_AT)
+        with boot.phase("workers"):
+            self.weights_downloader = WeightsDownloader()
+            size = len(COMFYUI_SERVER.split(",")) if COMFYUI_SERVER else COMFYUI_WORKERS
+            self.pool = WorkerPool(
+                size, self.make_worker, CheckpointResidency(RESIDENT_CHECKPOINTS)
+            )
+
+        # The servers take longest to start. Everything up to the warm-up
+        # runs alongside them, and the asyncio client is only imported here.
+        background = ThreadPoolExecutor(max_workers=2, thread_name_prefix="setup")
+        servers = background.submit(boot.run, "servers", "servers", self.pool.start)
+        background.submit(
+            boot.run,
+            "async_client",
+            "imports",
+            importlib.import_module,
+            "helpers.comfyui_async",
         )
+        background.shutdown(wait=False)
 
-    def cleanup(self):
-        self.comfyUI.clear_queue()
-        for directory in [OUTPUT_DIR, INPUT_DIR, COMFYUI_TEMP_OUTPUT_DIR]:
+        with boot.phase("manifest"):
+            self.weights_downloader.weights_map
+
+        # Template weights download in the background, the first prediction
+        # only waits for the ones its own workflow needs
+        with boot.phase("template_weights"):
+            self.pin_template_weights()
+            self.pool.primary.comfyUI.load_workflow(
+                workflow_templates.get(STYLE_TRANSFER_WORKFLOW).overlay(),
+                handle_inputs=False,
+                handle_weights=True,
+                wait_for_weights=False,
+            )
+
+        # Checkpoints are read into the page cache while the servers start
+        self.prefetcher = None
+        if PREFETCH_MEMORY_GB != 0:
+            budget = PREFETCH_MEMORY_GB * 1024**3
+            if PREFETCH_MEMORY_GB < 0:
+                budget = (available_memory() or 0) // 2
+            self.prefetcher = CheckpointPrefetcher(int(budget))
+            for preset in self.warmup_presets() or ["fast"]:
+                self.prefetch_checkpoint(CHECKPOINTS[preset], evict=False)
+
+        self.encode_pool = ThreadPoolExecutor(
+            max_workers=MAX_ENCODE_WORKERS, thread_name_prefix="encode"
+        )
+        self.embeds_cache = (
+            FileCache(
+                "IPAdapter embeds", EMBEDS_CACHE_DIR, EMBEDS_CACHE_MB * 1024 * 1024
+            )
+            if EMBEDS_CACHE_MB
+            else None
+        )
+        self.depth_cache = (
+            FileCache("Depth maps", DEPTH_CACHE_DIR, DEPTH_CACHE_MB * 1024 * 1024)
+            if DEPTH_CACHE_MB
+            else None
+        )
+        self.profile_stats = ProfileStats("model")
+        # Input files that prepared or running predictions reference, by
+        # name, with how many do. Pruning never takes them.
+        self.inputs_lock = threading.Lock()
+        self.inputs_in_use = collections.Counter()
+        # Predictions whose outputs may still be encoding or being returned
+        self.active_predictions = 0
+        # Output directories of finished predictions, which cog may still be
+        # uploading from, with when they finished, oldest first. Each goes
+        # OUTPUT_RETENTION_SECONDS later.
+        self.finished_outputs = collections.deque()
+        self.finished_outputs_lock = threading.Lock()
+        shutil.rmtree(OUTPUT_DIR, ignore_errors=True)
+        # Predictions in flight at once, beyond this they wait for a slot.
+        # Predictions share the event loop, so the count needs no lock.
+        self.prediction_slots = asyncio.Semaphore(MAX_CONCURRENT_PREDICTIONS)
+        self.async_clients = {}
+        self.batcher = (
+            MicroBatcher(self.run_batch, BATCH_MAX_WAIT_MS / 1000, BATCH_MAX_SIZE)
+            if BATCH_MAX_WAIT_MS
+            else None
+        )
+
+        with boot.phase("wait_for_servers"):
+            servers.result()
+        for worker in self.pool.workers:
+            for name, start, end in getattr(worker.comfyUI, "boot_spans", []):
+                boot.add_span(name, f"worker {worker.index}", start, end)
+
+        self.warm_up()
+        boot.report()
+        if PROFILE_DIR:
+            # Apart from the prompt profiles, which are read back as a set
+            boot.save(os.path.join(PROFILE_DIR, "boot"))
+
+    def pin_template_weights(self):
+        # Weights any preset of the templates needs stay out of reach of
+        # the weights cache's eviction
+        comfyUI = self.pool.primary.comfyUI
+        weights = []
+        for model in MODELS:
+            for workflow in preset_workflows(model):
+                weights.extend(comfyUI.collect_weights(workflow))
+        self.weights_downloader.pin(weights)
+
+    def make_worker(self, index):
+        output_directory, input_directory = worker_directories(index)
+        if COMFYUI_SERVER:
+            address = COMFYUI_SERVER.split(",")[index].strip()
+        else:
+            address = f"127.0.0.1:{COMFYUI_BASE_PORT + index}"
+
+        extra_args = []
+        if COMFYUI_CUDA_DEVICES:
+            devices = COMFYUI_CUDA_DEVICES.split(",")
+            extra_args = ["--cuda-device", devices[index % len(devices)].strip()]
+
+        comfyUI = ComfyUI(
+            address,
+            preview_method=PREVIEW_METHOD,
+            weights_downloader=self.weights_downloader,
+            extra_args=extra_args,
+        )
+        return Worker(
+            index,
+            comfyUI,
+            output_directory,
+            input_directory,
+            external=bool(COMFYUI_SERVER),
+        )
+
+    def warmup_presets(self):
+        if WARMUP_PRESETS == "all":
+            return MODELS
+        if WARMUP_PRESETS == "none":
+            return []
+        presets = [p.strip() for p in WARMUP_PRESETS.split(",") if p.strip()]
+        unknown = [p for p in presets if p not in MODELS]
+        if unknown:
+            print(f"Ignoring unknown warm-up presets: {', '.join(unknown)}")
+        return [p for p in presets if p in MODELS]
+
+    def prefetch_checkpoint(self, ckpt_name, evict=True):
+        weight = self.weights_downloader.weights_map[ckpt_name]
+        self.prefetcher.prefetch(
+            ckpt_name,
+            os.path.join(weight.dest, ckpt_name),
+            ready=self.weights_downloader.download_weights_async(ckpt_name),
+            evict=evict,
+        )
+
+    def prefetch_next_checkpoint(self):
+        # The most requested checkpoint that no worker has loaded is the
+        # likeliest to be read from disk next
+        residency = self.pool.residency
+        with residency.lock:
+            resident = {name for names in residency.resident.values() for name in names}
+            ranked = residency.popularity.most_common()
+        for ckpt_name, _ in ranked:
+            if ckpt_name not in resident:
+                self.prefetch_checkpoint(ckpt_name)
+                return
+
+    def warm_up(self):
+        workflows = {
+            preset: preset_workflows(preset) for preset in self.warmup_presets()
+        }
+        self.warmer = PresetWarmer(
+            self.pool,
+            workflows,
+            load_checkpoints=WARMUP_LOAD_CHECKPOINTS,
+            status_file=PRESET_READINESS_FILE,
+        )
+        self.warmer.start()
+
+    def preset_readiness(self):
+        return dict(self.warmer.status)
+
+    def cleanup(self, worker):
+        # Other predictions may have prompts queued on the worker, and other
+        # workers write to ComfyUI's shared temp directory, so both are only
+        # cleared when no other prediction is active. Outputs are in a
+        # directory per prediction, see output_directory.
+        if self.active_predictions > 1 or worker.in_flight > 1:
+            return
+        worker.comfyUI.clear_queue()
+        for directory in [worker.output_directory, COMFYUI_TEMP_OUTPUT_DIR]:
             if os.path.exists(directory):
                 shutil.rmtree(directory)
             os.makedirs(directory)
 
-    def handle_input_file(self, input_file: Path, filename: str = "image.png"):
-        image = Image.open(input_file)
-        image.save(os.path.join(INPUT_DIR, filename))
-
-    def log_and_collect_files(self, directory, prefix=""):
-        files = []
-        for f in os.listdir(directory):
-            if f == "__MACOSX":
-                continue
-            path = os.path.join(directory, f)
-            if os.path.isfile(path):
-                print(f"{prefix}{f}")
-                files.append(Path(path))
-            elif os.path.isdir(path):
-                print(f"{prefix}{f}/")
-                files.extend(self.log_and_collect_files(path, prefix=f"{prefix}{f}/"))
-        return files
-
-    def set_weights(self, workflow, model: str):
-        loader = workflow["2"]["inputs"]
-        sampler = workflow["3"]["inputs"]
+    def output_directory(self):
+        # Removes the outputs of predictions that finished long enough ago,
+        # then makes this prediction's own directory
+        expired = []
+        with self.finished_outputs_lock:
+            while (
+                self.finished_outputs
+                and self.finished_outputs[0][0] < time.time() - OUTPUT_RETENTION_SECONDS
+            ):
+                expired.append(self.finished_outputs.popleft()[1])
+        for finished in expired:
+            shutil.rmtree(finished, ignore_errors=True)
+        directory = os.path.join(OUTPUT_DIR, uuid.uuid4().hex)
+        os.makedirs(directory)
+        return directory
+
+    def prune_inputs(self, input_directory):
+        # Inputs are named by content and kept across requests, so that
+        # ComfyUI sees identical LoadImage inputs and reuses cached outputs.
+        # Least recently used files go once the directory is over budget,
+        # except those a prediction in flight still needs.
+        with self.inputs_lock:
+            files = []
+            for f in os.listdir(input_directory):
+                path = os.path.join(input_directory, f)
+                if os.path.isfile(path):
+                    files.append((os.stat(path), f, path))
+
+            total_bytes = sum(stat.st_size for stat, _, _ in files)
+            for stat, f, path in sorted(files, key=lambda file: file[0].st_mtime):
+                if total_bytes <= INPUT_CACHE_MB * 1024 * 1024:
+                    break
+                if f in self.inputs_in_use:
+                    continue
+                os.remove(path)
+                total_bytes -= stat.st_size
+
+    def hold_inputs(self, inputs, filenames):
+        # Marks filenames as needed by the prediction whose list inputs is,
+        # callers hold inputs_lock
+        for filename in filenames:
+            self.inputs_in_use[filename] += 1
+            inputs.append(filename)
+
+    def release_inputs(self, inputs):
+        with self.inputs_lock:
+            self.inputs_in_use -= collections.Counter(inputs)
+
+    def handle_input_file(self, input_file: Path, input_directory, inputs=None):
+        # With inputs, the file is held for that prediction before it is
+        # written, so pruning cannot remove it until the prediction ends
+        with Image.open(input_file) as image:
+            image_format = image.format
+
+        name = self.file_hash(input_file)[:32]
+        if image_format in PASSTHROUGH_FORMATS:
+            # LoadImage can decode the upload itself, so skip the PNG re-encode
+            filename = f"{name}.{PASSTHROUGH_FORMATS[image_format]}"
+        else:
+            filename = f"{name}.png"
+        if inputs is not None:
+            with self.inputs_lock:
+                self.hold_inputs(inputs, [filename])
+
+        if image_format in PASSTHROUGH_FORMATS:
+            link_or_copy(input_file, os.path.join(input_directory, filename))
+        else:
+            path = os.path.join(input_directory, filename)
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                with Image.open(input_file) as image:
+                    image.save(path)
+
+        return filename
+
+    def file_hash(self, path):
+        return file_hash(str(path), os.path.getsize(path), os.path.getmtime(path))
+
+    def encode_image(
+        self, image, output_format, output_quality, directory, prefix="ComfyUI"
+    ):
+        start = time.time()
+        pil_image = Image.frombuffer(
+            "RGB",
+            (image["width"], image["height"]),
+            image["pixels"],
+            "raw",
+            "RGB",
+            0,
+            1,
+        )
+        path = Path(
+            os.path.join(directory, f"{prefix}_{image['index']:05}.{output_format}")
+        )
+        if output_format == "png":
+            pil_image.save(path)
+        else:
+            pil_image.save(path, quality=output_quality, optimize=True)
+
+        encoded_bytes = os.path.getsize(path)
+        saved_bytes = len(image["pixels"]) - encoded_bytes
+        print(
+            f"{path.name}: encoded in {time.time() - start:.3f}s, size: {encoded_bytes / 1024:.0f}KB, saved: {saved_bytes / 1024:.0f}KB"
+        )
+        return path
+
+    def save_preview(self, data, image_format, number, directory, prefix="preview"):
+        # Previews arrive already encoded, so they are written as they are
+        path = Path(os.path.join(directory, f"{prefix}_{number:03}.{image_format}"))
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def get_cached_inputs(self, cache, key, input_directory, inputs):
+        # Linked and held in one go, so pruning cannot come in between
+        with self.inputs_lock:
+            entry = cache.get(key, input_directory)
+            if entry:
+                self.hold_inputs(inputs, entry["files"].values())
+        return entry
+
+    def use_cached_embeds(self, workflow, style_image, input_directory, inputs):
+        # Swap the IPAdapter node for IPAdapterEmbeds. On a hit it is fed
+        # the cached embeds; on a miss an IPAdapterEncoder feeds it and the
+        # embeds are saved for next time.
+        preset = workflow["1"]["inputs"]["preset"]
+        key = self.embeds_cache.key(self.file_hash(style_image), preset)
+        entry = self.get_cached_inputs(self.embeds_cache, key, input_directory, inputs)
+
+        ipadapter = workflow["4"]["inputs"]
+        workflow["4"] = {
+            "inputs": {
+                "weight": ipadapter["weight"],
+                "weight_type": ipadapter["weight_type"],
+                "start_at": ipadapter["start_at"],
+                "end_at": ipadapter["end_at"],
+                "embeds_scaling": "V only",
+                "model": ipadapter["model"],
+                "ipadapter": ipadapter["ipadapter"],
+                "pos_embed": ["30", 0],
+                "neg_embed": ["30", 1],
+            },
+            "class_type": "IPAdapterEmbeds",
+            "_meta": {"title": "IPAdapter Embeds"},
+        }
+
+        if entry:
+            print(f"Using cached IPAdapter embeds {key}")
+            for name, node_id in [("pos", "30"), ("neg", "31")]:
+                filename = entry["files"][name]
+                workflow[node_id] = {
+                    "inputs": {"embeds": filename},
+                    "class_type": "IPAdapterLoadEmbeds",
+                    "_meta": {"title": f"IPAdapter Load Embeds ({name})"},
+                }
+            workflow["4"]["inputs"]["neg_embed"] = ["31", 0]
+            workflow.pop("5")
+            print(f"IPAdapter embeds cache: {self.embeds_cache.stats()}")
+            return key, True
+
+        workflow["30"] = {
+            "inputs": {"weight": 1, "ipadapter": ["1", 1], "image": ["5", 0]},
+            "class_type": "IPAdapterEncoder",
+            "_meta": {"title": "IPAdapter Encoder"},
+        }
+        for name, output, node_id in [("pos", 0, "31"), ("neg", 1, "32")]:
+            workflow[node_id] = {
+                "inputs": {
+                    "embeds": ["30", output],
+                    "filename_prefix": f"{EMBEDS_OUTPUT_SUBFOLDER}/{key}_{name}",
+                },
+                "class_type": "IPAdapterSaveEmbeds",
+                "_meta": {"title": f"IPAdapter Save Embeds ({name})"},
+            }
+        return key, False
+
+    def store_embeds(self, key, worker, node_timings):
+        files = {}
+        for name in ["pos", "neg"]:
+            saved = glob.glob(
+                os.path.join(
+                    worker.output_directory,
+                    EMBEDS_OUTPUT_SUBFOLDER,
+                    f"{key}_{name}*.ipadpt",
+                )
+            )
+            if not saved:
+                print(f"IPAdapter embeds {key} were not saved, not caching them")
+                return
+            files[name] = saved[0]
+
+        encode_seconds = node_timings.get("30", 0.0)
+        self.embeds_cache.put(key, files, encode_seconds)
+        print(f"IPAdapter embeds cache: {self.embeds_cache.stats()}")
+
+    def use_cached_depth_map(self, workflow, structure_image, input_directory, inputs):
+        # On a hit the stored depth map is loaded straight into the
+        # controlnet and the preprocessor node is dropped, so its model is
+        # never loaded or even checked for. On a miss the depth map is saved.
+        preprocessor = workflow["19"]["inputs"]
+        resize = workflow["22"]["inputs"]
+        key = self.depth_cache.key(
+            self.file_hash(structure_image),
+            preprocessor["preprocessor"],
+            preprocessor["resolution"],
+            resize["width"],
+            resize["height"],
+            resize["interpolation"],
+            resize["keep_proportion"],
+        )
+        entry = self.get_cached_inputs(self.depth_cache, key, input_directory, inputs)
+        controlnet = workflow[workflow.slots["controlnet"]]["inputs"]
+
+        if entry:
+            print(f"Using cached depth map {key}")
+            filename = entry["files"]["depth"]
+            workflow["40"] = {
+                "inputs": {"image": filename, "upload": "image"},
+                "class_type": "LoadImage",
+                "_meta": {"title": "Load Cached Depth Map"},
+            }
+            controlnet["image"] = ["40", 0]
+            workflow.pop("19")
+            print(f"Depth map cache: {self.depth_cache.stats()}")
+            return key, True
+
+        workflow["41"] = {
+            "inputs": {
+                "filename_prefix": f"{DEPTH_OUTPUT_SUBFOLDER}/{key}",
+                "images": controlnet["image"],
+            },
+            "class_type": "SaveImage",
+            "_meta": {"title": "Save Depth Map"},
+        }
+        return key, False
+
+    def store_depth_map(self, key, worker, node_timings):
+        saved = glob.glob(
+            os.path.join(worker.output_directory, DEPTH_OUTPUT_SUBFOLDER, f"{key}*.png")
+        )
+        if not saved:
+            print(f"Depth map {key} was not saved, not caching it")
+            return
+
+        preprocess_seconds = node_timings.get("19", 0.0)
+        self.depth_cache.put(key, {"depth": saved[0]}, preprocess_seconds)
+        print(f"Depth map cache: {self.depth_cache.stats()}")
+
+    def batch_key(self, request):
+        # KSampler takes one conditioning and one seed per batch, so only
+        # requests that agree on everything else can share a sampler run
+        return (
+            request["model"],
+            request["width"],
+            request["height"],
+            request["prompt"],
+            request["negative_prompt"],
+            self.file_hash(request["style_image"]),
+            (
+                self.file_hash(request["structure_image"])
+                if request["structure_image"]
+                else None
+            ),
+            request["structure_depth_strength"],
+            request["structure_denoising_strength"],
+        )
+
+    def run_batch(self, requests):
+        total = sum(request["number_of_images"] for request in requests)
+        images = self.run_prediction(**{**requests[0], "number_of_images": total})
+
+        results = []
+        for request in requests:
+            count = request["number_of_images"]
+            results.append(
+                [
+                    {**image, "index": index}
+                    for index, image in enumerate(images[:count])
+                ]
+            )
+            images = images[count:]
+        return results
+
+    @staticmethod
+    def set_weights(workflow, model: str):
+        loader = workflow[workflow.slots["loader"]]["inputs"]
+        sampler = workflow[workflow.slots["sampler"]]["inputs"]
 
         if model == "fast":
             sampler["steps"] = 4
@@ -67,38 +639,43 @@ class Predictor(BasePredictor):
             sampler["cfg"] = 8
             sampler["sampler_name"] = "dpmpp_2m_sde_gpu"
 
-        if model == "fast":
-            loader["ckpt_name"] = "dreamshaperXL_lightningDPMSDE.safetensors"
-        elif model == "high-quality":
-            loader["ckpt_name"] = "albedobaseXL_v21.safetensors"
-        elif model == "realistic":
-            loader["ckpt_name"] = "RealVisXL_V4.0.safetensors"
-        elif model == "cinematic":
-            loader["ckpt_name"] = "CinematicRedmond.safetensors"
-        elif model == "animated":
-            loader["ckpt_name"] = "starlightXLAnimated_v3.safetensors"
+        if model in CHECKPOINTS:
+            loader["ckpt_name"] = CHECKPOINTS[model]
 
     def update_workflow(self, workflow, **kwargs):
         self.set_weights(workflow, kwargs["model"])
         workflow["6"]["inputs"]["text"] = kwargs["prompt"]
         workflow["7"]["inputs"]["text"] = f"nsfw, nude, {kwargs['negative_prompt']}"
+        workflow["5"]["inputs"]["image"] = kwargs["style_filename"]
+
+        # Outputs come back over the websocket instead of through the output
+        # directory, and nothing reads the preview of the depth map
+        workflow["9"] = {
+            "inputs": {"images": workflow["9"]["inputs"]["images"]},
+            "class_type": "SaveImageWebsocketRaw",
+            "_meta": {"title": "Save Image Websocket Raw"},
+        }
+        workflow.pop("20", None)
 
-        sampler = workflow["3"]["inputs"]
+        sampler = workflow[workflow.slots["sampler"]]["inputs"]
         sampler["seed"] = kwargs["seed"]
 
         if kwargs["is_structure"]:
             sampler["denoise"] = kwargs["structure_denoising_strength"]
-            workflow["18"]["inputs"]["strength"] = kwargs[
+            workflow[workflow.slots["controlnet"]]["inputs"]["strength"] = kwargs[
                 "structure_denoising_strength"
             ]
-            workflow["24"]["inputs"]["amount"] = kwargs["batch_size"]
+            workflow[workflow.slots["latent"]]["inputs"]["amount"] = kwargs[
+                "batch_size"
+            ]
+            workflow["21"]["inputs"]["image"] = kwargs["structure_filename"]
         else:
-            empty_latent_image = workflow["10"]["inputs"]
+            empty_latent_image = workflow[workflow.slots["latent"]]["inputs"]
             empty_latent_image["width"] = kwargs["width"]
             empty_latent_image["height"] = kwargs["height"]
             empty_latent_image["batch_size"] = kwargs["batch_size"]
 
-    def predict(
+    async def predict(
         self,
         style_image: Path = Input(
             description="Copy the style from this image",
@@ -125,7 +702,7 @@ class Predictor(BasePredictor):
         ),
         model: str = Input(
             description="Model to use for the generation",
-            choices=["fast", "high-quality", "realistic", "cinematic", "animated"],
+            choices=MODELS,
             default="fast",
         ),
         number_of_images: int = Input(
@@ -158,9 +735,185 @@ class Predictor(BasePredictor):
             description="Set a seed for reproducibility. Random by default.",
             default=None,
         ),
-    ) -> List[Path]:
+        return_previews: bool = Input(
+            description="Also return low resolution previews of the sampling steps as they are made. They come before the final images in the output. Only when the server sets PREVIEW_METHOD.",
+            default=False,
+        ),
+    ) -> AsyncIterator[Path]:
         """Run a single prediction on the model"""
-        self.cleanup()
+        request = {
+            "style_image": style_image,
+            "structure_image": structure_image,
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "width": width,
+            "height": height,
+            "model": model,
+            "number_of_images": number_of_images,
+            "structure_depth_strength": structure_depth_strength,
+            "structure_denoising_strength": structure_denoising_strength,
+            "seed": seed,
+        }
+
+        # A pinned seed has to reproduce, so it never joins a batch
+        if self.batcher and seed is None:
+            if return_previews:
+                print("Previews are not returned for batched predictions")
+            # Counted as active like any other prediction, so no other
+            # prediction wipes ComfyUI's temp directory under it
+            async with self.prediction_slots:
+                self.active_predictions += 1
+                directory = await asyncio.to_thread(self.output_directory)
+                try:
+                    images = await asyncio.to_thread(
+                        self.batcher.submit,
+                        self.batch_key(request),
+                        number_of_images,
+                        request,
+                    )
+                    futures = [
+                        self.encode_pool.submit(
+                            self.encode_image,
+                            image,
+                            output_format,
+                            output_quality,
+                            directory,
+                        )
+                        for image in images
+                    ]
+                    for future in futures:
+                        yield await asyncio.wrap_future(future)
+                finally:
+                    self.active_predictions -= 1
+                    self.finished_outputs.append((time.time(), directory))
+            return
+
+        if return_previews and PREVIEW_METHOD == "none":
+            print(
+                "Previews are disabled on this server, set PREVIEW_METHOD=latent2rgb to enable them"
+            )
+
+        async for path in self.stream_prediction(
+            request, output_format, output_quality, return_previews
+        ):
+            yield path
+
+    async def stream_prediction(self, request, output_format, output_quality, previews):
+        # The prompt runs on the event loop and every output is yielded as
+        # soon as it is written, while ComfyUI works on the rest. Each image
+        # starts encoding as soon as its frame arrives. Frames arrive in
+        # index order, so the outputs keep their order.
+        # Outputs go to a directory of this prediction's own, which stays
+        # for OUTPUT_RETENTION_SECONDS, so cog can still upload from it
+        outputs = asyncio.Queue()
+        directory = None
+        preview_count = 0
+
+        def encode(image):
+            outputs.put_nowait(
+                self.encode_pool.submit(
+                    self.encode_image,
+                    image,
+                    output_format,
+                    output_quality,
+                    directory,
+                )
+            )
+
+        def preview(data, image_format):
+            nonlocal preview_count
+            preview_count += 1
+            outputs.put_nowait(
+                self.encode_pool.submit(
+                    self.save_preview,
+                    data,
+                    image_format,
+                    preview_count,
+                    directory,
+                )
+            )
+
+        def release(future):
+            if not future.cancelled() and future.exception() is None:
+                self.release_inputs(future.result()["inputs"])
+
+        async def run():
+            prediction = None
+            preparing = asyncio.ensure_future(
+                asyncio.to_thread(self.prepare_prediction, **request)
+            )
+            try:
+                # Inputs, caches and weights are ready before a worker is
+                # held, so the worker is only held while the prompt runs
+                try:
+                    prediction = await asyncio.shield(preparing)
+                except asyncio.CancelledError:
+                    # The thread still holds its inputs, so let them go
+                    # once it is done
+                    preparing.add_done_callback(release)
+                    raise
+                async with self.pool.acquire_async(
+                    ckpt_name=prediction["ckpt_name"]
+                ) as worker:
+                    await self.run_prediction_async(
+                        worker,
+                        prediction,
+                        on_image=encode,
+                        on_preview=preview if previews else None,
+                    )
+            except Exception as e:
+                outputs.put_nowait(e)
+            finally:
+                if prediction is not None:
+                    self.release_inputs(prediction["inputs"])
+                outputs.put_nowait(None)
+
+        start = time.time()
+        async with self.prediction_slots:
+            self.active_predictions += 1
+            directory = await asyncio.to_thread(self.output_directory)
+            task = asyncio.create_task(run())
+            count = 0
+            try:
+                while True:
+                    output = await outputs.get()
+                    if output is None:
+                        break
+                    if isinstance(output, Exception):
+                        raise output
+
+                    path = await asyncio.wrap_future(output)
+                    count += 1
+                    if count == 1:
+                        print(f"First output after {time.time() - start:.2f}s")
+                    yield path
+            finally:
+                # Cancels the prompt if the caller stopped reading early
+                task.cancel()
+                self.active_predictions -= 1
+                self.finished_outputs.append((time.time(), directory))
+
+        print(f"{count} outputs in {time.time() - start:.2f}s")
+
+    def prepare_prediction(
+        self,
+        style_image,
+        structure_image,
+        prompt,
+        negative_prompt,
+        width,
+        height,
+        model,
+        number_of_images,
+        structure_depth_strength,
+        structure_denoising_strength,
+        seed,
+    ):
+        # Everything before the prompt is queued, which blocks on files and
+        # weight downloads. It needs no worker.
+        if not self.warmer.is_ready(model):
+            status = self.warmer.status.get(model, "cold")
+            print(f"Preset {model} is not warmed up yet: {status}")
 
         if seed is None:
             seed = random.randint(0, 2**32 - 1)
@@ -169,48 +922,140 @@ class Predictor(BasePredictor):
         if not style_image:
             raise ValueError("Style image is required")
 
-        self.handle_input_file(style_image)
+        os.makedirs(INPUT_DIR, exist_ok=True)
+        self.prune_inputs(INPUT_DIR)
+        # The input files it references are held until release_inputs()
+        inputs = []
+        try:
+            style_filename = self.handle_input_file(style_image, INPUT_DIR, inputs)
+            structure_filename = None
 
-        if structure_image:
-            self.handle_input_file(structure_image, "structure.png")
-            workflow = json.loads(STYLE_TRANSFER_WITH_STRUCTURE_WORKFLOW_JSON)
-        else:
-            workflow = json.loads(STYLE_TRANSFER_WORKFLOW_JSON)
-
-        self.update_workflow(
-            workflow,
-            prompt=prompt,
-            negative_prompt=negative_prompt,
-            seed=seed,
-            width=width,
-            height=height,
-            batch_size=number_of_images,
-            model=model,
-            is_structure=bool(structure_image),
-            structure_depth_strength=structure_depth_strength,
-            structure_denoising_strength=structure_denoising_strength,
-        )
-
-        wf = self.comfyUI.load_workflow(workflow, handle_weights=True)
-        self.comfyUI.connect()
-        self.comfyUI.run_workflow(wf)
-        files = self.log_and_collect_files(OUTPUT_DIR)
-
-        if output_quality < 100 or output_format in ["webp", "jpg"]:
-            optimised_files = []
-            for file in files:
-                if file.is_file() and file.suffix in [".jpg", ".jpeg", ".png"]:
-                    image = Image.open(file)
-                    optimised_file_path = file.with_suffix(f".{output_format}")
-                    image.save(
-                        optimised_file_path,
-                        quality=output_quality,
-                        optimize=True,
+            if structure_image:
+                structure_filename = self.handle_input_file(
+                    structure_image, INPUT_DIR, inputs
+                )
+                template = workflow_templates.get(
+                    STYLE_TRANSFER_WITH_STRUCTURE_WORKFLOW
+                )
+            else:
+                template = workflow_templates.get(STYLE_TRANSFER_WORKFLOW)
+
+            workflow = template.overlay()
+
+            self.update_workflow(
+                workflow,
+                prompt=prompt,
+                negative_prompt=negative_prompt,
+                seed=seed,
+                width=width,
+                height=height,
+                batch_size=number_of_images,
+                model=model,
+                is_structure=bool(structure_image),
+                structure_depth_strength=structure_depth_strength,
+                structure_denoising_strength=structure_denoising_strength,
+                style_filename=style_filename,
+                structure_filename=structure_filename,
+            )
+
+            prediction = {
+                "labels": {"model": model, "structure": bool(structure_image)},
+                "loader_id": workflow.slots["loader"],
+                "embeds_key": None,
+                "depth_key": None,
+                "inputs": inputs,
+            }
+            if self.embeds_cache:
+                prediction["embeds_key"], prediction["embeds_cached"] = (
+                    self.use_cached_embeds(workflow, style_image, INPUT_DIR, inputs)
+                )
+            if self.depth_cache and structure_image:
+                prediction["depth_key"], prediction["depth_cached"] = (
+                    self.use_cached_depth_map(
+                        workflow, structure_image, INPUT_DIR, inputs
                     )
-                    optimised_files.append(optimised_file_path)
-                else:
-                    optimised_files.append(file)
+                )
+
+            prediction["ckpt_name"] = workflow[prediction["loader_id"]]["inputs"][
+                "ckpt_name"
+            ]
+            prediction["workflow"] = self.pool.primary.comfyUI.load_workflow(
+                workflow, handle_weights=True
+            )
+            return prediction
+        except BaseException:
+            self.release_inputs(inputs)
+            raise
+
+    def start_prompt(self, worker, prediction):
+        # Once the worker is held, just before the prompt is queued
+        print(f"Running on worker {worker.index} ({worker.comfyUI.server_address})")
+        self.cleanup(worker)
+        self.pool.residency.prepare(worker, prediction["ckpt_name"])
+
+    def finish_prediction(self, worker, prediction, trace):
+        self.pool.residency.record(
+            worker,
+            prediction["ckpt_name"],
+            trace.node_timings.get(prediction["loader_id"]),
+        )
+        if self.prefetcher:
+            load_seconds = trace.node_timings.get(prediction["loader_id"])
+            if load_seconds is not None:
+                self.prefetcher.record_load(prediction["ckpt_name"], load_seconds)
+            self.prefetch_next_checkpoint()
+            print(f"Prefetch: {self.prefetcher.stats()}")
+        self.profile_stats.add(trace)
+        print(f"Mean node seconds per preset: {self.profile_stats.stats()}")
+        print(f"Workers: {self.pool.stats()}")
+        if PROFILE_DIR:
+            trace.save(PROFILE_DIR)
 
-            files = optimised_files
+        if prediction["embeds_key"] and not prediction["embeds_cached"]:
+            self.store_embeds(prediction["embeds_key"], worker, trace.node_timings)
+        if prediction["depth_key"] and not prediction["depth_cached"]:
+            self.store_depth_map(prediction["depth_key"], worker, trace.node_timings)
 
-        return files
+    def run_prediction(self, on_image=None, on_preview=None, **request):
+        # On the sync client, which takes the worker for itself. Returns the
+        # output images in order.
+        prediction = self.prepare_prediction(**request)
+        try:
+            with self.pool.acquire(
+                ckpt_name=prediction["ckpt_name"], exclusive=True
+            ) as worker:
+                self.start_prompt(worker, prediction)
+                comfyUI = worker.comfyUI
+                comfyUI.connect()
+                comfyUI.run_workflow(
+                    prediction["workflow"],
+                    on_image=on_image,
+                    on_preview=on_preview,
+                    timeout=PROMPT_TIMEOUT,
+                    labels=prediction["labels"],
+                )
+                self.finish_prediction(worker, prediction, comfyUI.trace)
+                return sorted(comfyUI.output_images, key=lambda i: i["index"])
+        finally:
+            self.release_inputs(prediction["inputs"])
+
+    async def run_prediction_async(
+        self, worker, prediction, on_image=None, on_preview=None
+    ):
+        # Prompts of other predictions may be queued on the same server, the
+        # client routes each message to its prompt by prompt_id
+        await asyncio.to_thread(self.start_prompt, worker, prediction)
+        client = self.async_clients.get(worker.index)
+        if client is None or client.server_address != worker.comfyUI.server_address:
+            from helpers.comfyui_async import AsyncComfyUI
+
+            client = AsyncComfyUI(worker.comfyUI.server_address)
+            self.async_clients[worker.index] = client
+        trace = await client.run_workflow(
+            prediction["workflow"],
+            on_image=on_image,
+            on_preview=on_preview,
+            timeout=PROMPT_TIMEOUT,
+            labels=prediction["labels"],
+        )
+        await asyncio.to_thread(self.finish_prediction, worker, prediction, trace)
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+# Benchmarks Predictor.predict end to end against the stand-in ComfyUI
+# server in scripts/fake_comfyui.py, so bridge and predictor overhead can
+# be measured without a GPU. Node latencies are fixed, so differences
+# between runs come from this repository's code. Results are written as
+# JSON, tagged with the commit, and can be compared with an earlier run:
+#
+# python scripts/benchmark.py --output before.json
+# python scripts/benchmark.py --output after.json --compare before.json
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(REPO_DIR)
+
+WORKFLOWS = ["style", "structure"]
+# Files the predictor reads relative to its working directory
+WORKSPACE_FILES = [
+    "helpers",
+    "weights.json",
+    "style-transfer-api.json",
+    "style-transfer-with-structure-api.json",
+]
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    return {
+        "mean": statistics.mean(values),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": values[-1],
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_commit():
+    def git(*args):
+        return subprocess.run(
+            ["git", *args], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip()
+
+    return {
+        "commit": git("rev-parse", "--short", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+    }
+
+
+def prepare_workspace(workspace):
+    # The predictor resolves workflows, custom nodes and weights from its
+    # working directory. Weights only need to exist, not to be real.
+    from weights_downloader import weight_dest
+    from weights_manifest import WeightsManifest
+    from weights_store import WeightsStore
+
+    for name in WORKSPACE_FILES:
+        os.symlink(os.path.join(REPO_DIR, name), os.path.join(workspace, name))
+    os.makedirs(os.path.join(workspace, "ComfyUI", "custom_nodes"))
+
+    os.chdir(workspace)
+    # Every weight is the same empty blob in the workspace's own store
+    store = WeightsStore()
+    with io.BytesIO() as empty:
+        blob = store.store_file(empty)
+    for weight in WeightsManifest().weights_map.values():
+        ref = store.write_ref(
+            weight.url, [{"path": os.path.basename(weight.name), **blob}]
+        )
+        store.materialise(ref, weight_dest(weight.name, weight.dest))
+
+
+def synthetic_image(path, width, height, image_format):
+    # Noise, so every request has new content and misses the input caches
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+    image.resize((width, height)).save(path, format=image_format)
+    return path
+
+
+def start_server(args, port, output_dir, input_dir):
+    command = [
+        sys.executable,
+        os.path.join(REPO_DIR, "scripts", "fake_comfyui.py"),
+        "--port",
+        str(port),
+        "--output-directory",
+        output_dir,
+        "--input-directory",
+        input_dir,
+        "--latency-scale",
+        str(args.latency_scale),
+    ]
+    for latency in args.latency:
+        command += ["--latency", latency]
+    return subprocess.Popen(
+        command, stdout=subprocess.DEVNULL if not args.verbose else None
+    )
+
+
+async def run_request(predictor, args, workflow, images_dir):
+    from cog import Path
+
+    name = uuid.uuid4().hex
+    style_image = synthetic_image(
+        os.path.join(images_dir, f"{name}_style.jpg"), 1024, 1024, "JPEG"
+    )
+    structure_image = None
+    if workflow == "structure":
+        structure_image = synthetic_image(
+            os.path.join(images_dir, f"{name}_structure.png"), 1024, 768, "PNG"
+        )
+
+    start = time.time()
+    first_output = None
+    outputs = []
+    async for output in predictor.predict(
+        style_image=Path(style_image),
+        structure_image=Path(structure_image) if structure_image else None,
+        prompt="An astronaut riding a unicorn",
+        negative_prompt="",
+        width=1024,
+        height=1024,
+        model=random.choice(args.model.split(",")),
+        number_of_images=args.number_of_images,
+        structure_depth_strength=1.0,
+        structure_denoising_strength=0.65,
+        output_format=args.output_format,
+        output_quality=80,
+        seed=None,
+        return_previews=False,
+    ):
+        if first_output is None:
+            first_output = time.time() - start
+        outputs.append(output)
+
+    if len(outputs) != args.number_of_images:
+        raise RuntimeError(
+            f"Expected {args.number_of_images} outputs, got {len(outputs)}"
+        )
+    return time.time() - start, first_output
+
+
+def read_profiles(profile_dir):
+    profiles = []
+    for filename in os.listdir(profile_dir):
+        if filename.endswith(".json") and not filename.endswith(".trace.json"):
+            with open(os.path.join(profile_dir, filename)) as f:
+                profiles.append(json.load(f))
+    return profiles
+
+
+def summarise_profiles(profiles):
+    bridge = {}
+    nodes = {}
+    for profile in profiles:
+        for name, seconds in profile["bridge_seconds"].items():
+            bridge.setdefault(name, []).append(seconds)
+        for node in profile["nodes"]:
+            nodes.setdefault(node["class_type"], []).append(node["seconds"])
+
+    return {
+        "bridge_ms": {
+            name: statistics.mean(values) * 1000 for name, values in bridge.items()
+        },
+        "bridge_total_ms": statistics.mean(
+            sum(profile["bridge_seconds"].values()) for profile in profiles
+        )
+        * 1000,
+        "queue_wait_ms": statistics.mean(
+            profile["queue_wait_seconds"] for profile in profiles
+        )
+        * 1000,
+        "output_collection_ms": statistics.mean(
+            profile["output_collection_seconds"] for profile in profiles
+        )
+        * 1000,
+        "prompt_seconds": statistics.mean(
+            profile["total_seconds"] for profile in profiles
+        ),
+        "node_seconds": {
+            class_type: statistics.mean(values) for class_type, values in nodes.items()
+        },
+    }
+
+
+async def run_scenario(predictor, args, workflow, concurrency, images_dir, profile_dir):
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    os.makedirs(profile_dir)
+
+    # One unmeasured request, so the stand-in's node cache is in the same
+    # state for every scenario
+    await run_request(predictor, args, workflow, images_dir)
+    shutil.rmtree(profile_dir)
+    os.makedirs(profile_dir)
+
+    switches = predictor.pool.residency.stats()["switches"]
+    for worker in predictor.pool.workers:
+        worker.peak_in_flight = worker.in_flight
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_client():
+        async with slots:
+            return await run_request(predictor, args, workflow, images_dir)
+
+    start = time.time()
+    results = await asyncio.gather(*[run_client() for _ in range(args.requests)])
+    wall = time.time() - start
+
+    latencies = [latency for latency, _ in results]
+    first_outputs = [first for _, first in results]
+    scenario = {
+        "workflow": workflow,
+        "concurrency": concurrency,
+        "requests": args.requests,
+        "throughput_rps": args.requests / wall,
+        "latency_s": percentiles(latencies),
+        "first_output_s": percentiles(first_outputs),
+        "checkpoint_switches": predictor.pool.residency.stats()["switches"] - switches,
+        # Most prompts queued on one server at once
+        "peak_prompts_per_server": max(
+            worker.peak_in_flight for worker in predictor.pool.workers
+        ),
+    }
+    profiles = read_profiles(profile_dir)
+    if profiles:
+        scenario.update(summarise_profiles(profiles))
+    # Time spent in the predictor and bridge rather than in the nodes
+    scenario["overhead_ms"] = (
+        scenario["latency_s"]["mean"] - scenario.get("prompt_seconds", 0)
+    ) * 1000
+    return scenario
+
+
+def benchmark_encoding(predictor, args, images_dir):
+    # Input handling and output encoding on their own, per image
+    from cog import Path
+    from PIL import Image
+
+    results = {}
+    input_directory = predictor.pool.primary.input_directory
+    for name, image_format, extension in [
+        ("input_jpeg", "JPEG", "jpg"),
+        ("input_png", "PNG", "png"),
+        ("input_bmp", "BMP", "bmp"),
+    ]:
+        cold = []
+        warm = []
+        for _ in range(args.encode_samples):
+            path = synthetic_image(
+                os.path.join(images_dir, f"{uuid.uuid4().hex}.{extension}"),
+                1024,
+                1024,
+                image_format,
+            )
+            start = time.time()
+            predictor.handle_input_file(Path(path), input_directory)
+            cold.append(time.time() - start)
+            start = time.time()
+            predictor.handle_input_file(Path(path), input_directory)
+            warm.append(time.time() - start)
+        results[name] = {
+            "cold_ms": statistics.mean(cold) * 1000,
+            "warm_ms": statistics.mean(warm) * 1000,
+        }
+
+    pixels = Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3))
+    pixels = pixels.resize((1024, 1024)).tobytes()
+    image = {"width": 1024, "height": 1024, "index": 0, "pixels": memoryview(pixels)}
+    output_directory = predictor.output_directory()
+    for output_format in ["webp", "jpg", "png"]:
+        timings = []
+        for _ in range(args.encode_samples):
+            start = time.time()
+            predictor.encode_image(
+                image, output_format, 80, output_directory, prefix="benchmark"
+            )
+            timings.append(time.time() - start)
+        results[f"output_{output_format}"] = {"ms": statistics.mean(timings) * 1000}
+    return results
+
+
+def print_results(results, baseline=None):
+    def delta(value, old):
+        if old is None or not old:
+            return ""
+        return f" ({(value - old) / old * 100:+.1f}%)"
+
+    baseline_scenarios = {}
+    if baseline:
+        print(f"Compared with {baseline['commit']}")
+        baseline_scenarios = {
+            (s["workflow"], s["concurrency"]): s for s in baseline["scenarios"]
+        }
+
+    print(f"Setup: {results['setup_s']:.2f}s")
+    for scenario in results["scenarios"]:
+        old = baseline_scenarios.get((scenario["workflow"], scenario["concurrency"]))
+        print(f"{scenario['workflow']}, concurrency {scenario['concurrency']}:")
+        for name, value, unit in [
+            ("latency p50", scenario["latency_s"]["p50"], "s"),
+            ("latency p90", scenario["latency_s"]["p90"], "s"),
+            ("first output p50", scenario["first_output_s"]["p50"], "s"),
+            ("throughput", scenario["throughput_rps"], " req/s"),
+            ("overhead", scenario["overhead_ms"], "ms"),
+            ("bridge", scenario.get("bridge_total_ms", 0), "ms"),
+            ("queue wait", scenario.get("queue_wait_ms", 0), "ms"),
+            ("output collection", scenario.get("output_collection_ms", 0), "ms"),
+            ("checkpoint switches", scenario.get("checkpoint_switches", 0), ""),
+            ("prompts per server", scenario.get("peak_prompts_per_server", 0), ""),
+        ]:
+            old_value = None
+            if old:
+                old_value = {
+                    "latency p50": old["latency_s"]["p50"],
+                    "latency p90": old["latency_s"]["p90"],
+                    "first output p50": old["first_output_s"]["p50"],
+                    "throughput": old["throughput_rps"],
+                    "overhead": old["overhead_ms"],
+                    "bridge": old.get("bridge_total_ms"),
+                    "queue wait": old.get("queue_wait_ms"),
+                    "output collection": old.get("output_collection_ms"),
+                    "checkpoint switches": old.get("checkpoint_switches"),
+                    "prompts per server": old.get("peak_prompts_per_server"),
+                }[name]
+            print(f"  {name}: {value:.3f}{unit}{delta(value, old_value)}")
+
+    print("Encoding:")
+    for name, timings in results["encoding"].items():
+        old = baseline["encoding"].get(name, {}) if baseline else {}
+        print(
+            f"  {name}: "
+            + ", ".join(
+                f"{key} {value:.2f}{delta(value, old.get(key))}"
+                for key, value in timings.items()
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the predictor against a stand-in ComfyUI server"
+    )
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument(
+        "--concurrency",
+        default="1,4",
+        help="Comma separated numbers of concurrent requests",
+    )
+    parser.add_argument("--workflows", default=",".join(WORKFLOWS))
+    parser.add_argument(
+        "--model",
+        default="fast",
+        help="Comma separated presets, each request picks one at random",
+    )
+    parser.add_argument("--number-of-images", type=int, default=1)
+    parser.add_argument("--output-format", default="webp")
+    parser.add_argument("--encode-samples", type=int, default=5)
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="CLASS=SECONDS",
+        help="Override a node latency of the stand-in server",
+    )
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of stand-in servers"
+    )
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run")
+    parser.add_argument("--keep-workspace", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    for name in ["output", "compare"]:
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    workspace = tempfile.mkdtemp(prefix="benchmark-")
+    profile_dir = os.path.join(workspace, "profiles")
+    images_dir = os.path.join(workspace, "images")
+    os.makedirs(images_dir)
+    prepare_workspace(workspace)
+
+    ports = [free_port() for _ in range(args.workers)]
+    # Read by predict.py when it is imported
+    os.environ["COMFYUI_SERVER"] = ",".join(f"127.0.0.1:{port}" for port in ports)
+    os.environ["PROFILE_DIR"] = profile_dir
+    # Inputs, outputs and the embeds and depth caches start empty each run
+    os.environ["TMP_DIR"] = os.path.join(workspace, "tmp")
+    os.makedirs(os.environ["TMP_DIR"])
+    os.environ.setdefault("WARMUP_PRESETS", "none")
+    os.environ.setdefault("PREVIEW_METHOD", "none")
+
+    import predict
+
+    servers = [
+        start_server(args, port, *predict.worker_directories(index))
+        for index, port in enumerate(ports)
+    ]
+    log = io.StringIO()
+    stdout = sys.stdout
+    try:
+        if not args.verbose:
+            sys.stdout = log
+        start = time.time()
+        predictor = predict.Predictor()
+        predictor.setup()
+        setup_seconds = time.time() - start
+
+        # Predictions share one event loop, as they do under cog
+        loop = asyncio.new_event_loop()
+        scenarios = []
+        for workflow in args.workflows.split(","):
+            for concurrency in args.concurrency.split(","):
+                scenarios.append(
+                    loop.run_until_complete(
+                        run_scenario(
+                            predictor,
+                            args,
+                            workflow,
+                            int(concurrency),
+                            images_dir,
+                            profile_dir,
+                        )
+                    )
+                )
+        encoding = benchmark_encoding(predictor, args, images_dir)
+        for client in predictor.async_clients.values():
+            loop.run_until_complete(client.close())
+        loop.close()
+    except Exception:
+        sys.stdout = stdout
+        print(log.getvalue()[-5000:])
+        raise
+    finally:
+        sys.stdout = stdout
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+        os.chdir(REPO_DIR)
+        if not args.keep_workspace:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    results = {
+        **git_commit(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "setup_s": setup_seconds,
+        "boot": predictor.boot.to_dict(),
+        "scenarios": scenarios,
+        "encoding": encoding,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+# A stand-in for the ComfyUI server, so the predictor and the bridge can be
+# benchmarked without a GPU. It speaks the same HTTP and websocket protocol
+# as ComfyUI for the endpoints the bridge uses, sleeps for a configurable
+# time per node instead of running it, and returns synthetic images.
+#
+# python scripts/fake_comfyui.py --port 8188 --output-directory /tmp/outputs \
+#     --input-directory /tmp/inputs --latency KSampler=0.05
+import argparse
+import asyncio
+import io
+import json
+import os
+import struct
+import time
+import uuid
+
+from aiohttp import web
+from PIL import Image
+
+# Binary websocket events, as in helpers/comfyui.py
+PREVIEW_IMAGE_EVENT = 1
+RAW_IMAGE_EVENT = 100
+
+# Seconds each node class takes, KSampler's is per step
+DEFAULT_LATENCIES = {
+    "CheckpointLoaderSimple": 0.01,
+    "IPAdapterUnifiedLoader": 0.01,
+    "ControlNetLoader": 0.01,
+    "LoadImage": 0.005,
+    "IPAdapterLoadEmbeds": 0.002,
+    "CLIPTextEncode": 0.01,
+    "IPAdapter": 0.05,
+    "IPAdapterEncoder": 0.04,
+    "IPAdapterEmbeds": 0.01,
+    "IPAdapterSaveEmbeds": 0.002,
+    "ImageResize+": 0.005,
+    "AIO_Preprocessor": 0.1,
+    "ControlNetApply": 0.005,
+    "VAEEncode": 0.03,
+    "RepeatLatentBatch": 0.001,
+    "EmptyLatentImage": 0.001,
+    "KSampler": 0.02,
+    "VAEDecode": 0.05,
+    "SaveImage": 0.01,
+    "PreviewImage": 0.005,
+    "SaveImageWebsocketRaw": 0.002,
+}
+DEFAULT_LATENCY = 0.001
+
+OUTPUT_NODES = {
+    "SaveImage",
+    "PreviewImage",
+    "SaveImageWebsocketRaw",
+    "IPAdapterSaveEmbeds",
+}
+MODEL_LOADER_NODES = {
+    "CheckpointLoaderSimple",
+    "IPAdapterUnifiedLoader",
+    "ControlNetLoader",
+}
+# IS_CHANGED returns nan for these, so ComfyUI never caches them
+ALWAYS_RUN_NODES = {"SaveImageWebsocketRaw"}
+# Nodes that read a file from the input directory, by input name
+INPUT_FILE_NODES = {"LoadImage": "image", "IPAdapterLoadEmbeds": "embeds"}
+
+
+def is_link(value):
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
+
+class FakeComfyUI:
+    def __init__(self, args):
+        self.output_directory = args.output_directory
+        self.input_directory = args.input_directory
+        self.preview_method = args.preview_method
+        self.fail_node_class = args.fail_node_class
+        self.latencies = dict(DEFAULT_LATENCIES)
+        for latency in args.latency:
+            class_type, seconds = latency.rsplit("=", 1)
+            self.latencies[class_type] = float(seconds)
+        self.latency_scale = args.latency_scale
+
+        self.clients = {}
+        self.queue = []
+        self.queue_changed = asyncio.Event()
+        self.running = None
+        self.interrupted = False
+        self.history = {}
+        self.number = 0
+        # Signature of each node's last execution, as ComfyUI's output cache
+        self.executed = {}
+        # Set by /free and applied before the next prompt, as ComfyUI does
+        self.unload_models = False
+        self.free_memory = False
+        self.pixels = {}
+        self.previews = {}
+        self.counter = 0
+
+    # HTTP
+
+    async def post_prompt(self, request):
+        body = await request.json()
+        prompt = body["prompt"]
+        node_errors = self.validate(prompt)
+        if node_errors:
+            return web.json_response(
+                {
+                    "error": {
+                        "type": "prompt_outputs_failed_validation",
+                        "message": "Prompt outputs failed validation",
+                    },
+                    "node_errors": node_errors,
+                },
+                status=400,
+            )
+
+        prompt_id = str(uuid.uuid4())
+        self.number += 1
+        self.queue.append((self.number, prompt_id, prompt, body.get("client_id")))
+        self.queue_changed.set()
+        return web.json_response(
+            {"prompt_id": prompt_id, "number": self.number, "node_errors": {}}
+        )
+
+    async def get_history(self, request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id is None:
+            return web.json_response(self.history)
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    async def get_queue(self, request):
+        running = []
+        if self.running:
+            number, prompt_id, prompt, client_id = self.running
+            running.append([number, prompt_id, prompt, {"client_id": client_id}])
+        return web.json_response(
+            {
+                "queue_running": running,
+                "queue_pending": [
+                    [number, prompt_id, prompt, {"client_id": client_id}]
+                    for number, prompt_id, prompt, client_id in self.queue
+                ],
+            }
+        )
+
+    async def post_queue(self, request):
+        body = await request.json()
+        if body.get("clear"):
+            self.queue = []
+        if "delete" in body:
+            deleted = set(body["delete"])
+            self.queue = [item for item in self.queue if item[1] not in deleted]
+        return web.Response()
+
+    async def post_interrupt(self, request):
+        if self.running:
+            self.interrupted = True
+        return web.Response()
+
+    async def post_free(self, request):
+        body = await request.json()
+        self.unload_models = self.unload_models or body.get("unload_models", False)
+        self.free_memory = self.free_memory or body.get("free_memory", False)
+        return web.Response()
+
+    def apply_free(self, prompt):
+        # Freeing memory also resets the output cache. Unloaded models are
+        # only reloaded when next used, which the stand-in counts against
+        # the loader node.
+        if self.free_memory:
+            self.executed = {}
+        elif self.unload_models:
+            for node_id in list(self.executed):
+                node = prompt.get(node_id)
+                if node and node["class_type"] in MODEL_LOADER_NODES:
+                    del self.executed[node_id]
+        self.unload_models = False
+        self.free_memory = False
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        self.clients[client_id] = ws
+        try:
+            await ws.send_str(
+                json.dumps(
+                    {
+                        "type": "status",
+                        "data": {
+                            "status": {
+                                "exec_info": {"queue_remaining": len(self.queue)}
+                            },
+                            "sid": client_id,
+                        },
+                    }
+                )
+            )
+            async for _ in ws:
+                pass
+        finally:
+            if self.clients.get(client_id) is ws:
+                del self.clients[client_id]
+        return ws
+
+    # Prompts
+
+    def validate(self, prompt):
+        node_errors = {}
+        for node_id, node in prompt.items():
+            errors = []
+            for name, value in node.get("inputs", {}).items():
+                if is_link(value) and value[0] not in prompt:
+                    errors.append(f"{name}: node {value[0]} does not exist")
+            input_name = INPUT_FILE_NODES.get(node.get("class_type"))
+            if input_name:
+                filename = node["inputs"].get(input_name, "")
+                if not os.path.exists(os.path.join(self.input_directory, filename)):
+                    errors.append(f"{input_name}: {filename} is not in the inputs")
+            if errors:
+                node_errors[node_id] = {
+                    "errors": errors,
+                    "class_type": node.get("class_type"),
+                }
+        if not any(node.get("class_type") in OUTPUT_NODES for node in prompt.values()):
+            node_errors["prompt"] = {"errors": ["Prompt has no outputs"]}
+        return node_errors
+
+    def execution_order(self, prompt):
+        # Inputs before the nodes that use them, starting from the outputs
+        order = []
+        seen = set()
+
+        def visit(node_id):
+            if node_id in seen:
+                return
+            seen.add(node_id)
+            for value in prompt[node_id].get("inputs", {}).values():
+                if is_link(value):
+                    visit(value[0])
+            order.append(node_id)
+
+        for node_id in sorted(prompt, key=lambda n: (len(n), n)):
+            if prompt[node_id].get("class_type") in OUTPUT_NODES:
+                visit(node_id)
+        return order
+
+    def signature(self, prompt, node_id, signatures):
+        if node_id not in signatures:
+            node = prompt[node_id]
+            inputs = {}
+            for name, value in node.get("inputs", {}).items():
+                if is_link(value):
+                    value = [self.signature(prompt, value[0], signatures), value[1]]
+                inputs[name] = value
+            input_name = INPUT_FILE_NODES.get(node.get("class_type"))
+            if input_name:
+                path = os.path.join(self.input_directory, inputs[input_name])
+                inputs["mtime"] = os.path.getmtime(path)
+            signatures[node_id] = json.dumps([node["class_type"], inputs])
+        return signatures[node_id]
+
+    def image_shape(self, prompt, node_id, shapes):
+        # Width, height and batch size of the images or latents a node makes
+        if node_id in shapes:
+            return shapes[node_id]
+
+        node = prompt[node_id]
+        inputs = node.get("inputs", {})
+        class_type = node["class_type"]
+        linked = [v[0] for v in inputs.values() if is_link(v)]
+
+        if class_type == "EmptyLatentImage":
+            shape = (inputs["width"], inputs["height"], inputs["batch_size"])
+        elif class_type == "LoadImage":
+            path = os.path.join(self.input_directory, inputs["image"])
+            with Image.open(path) as image:
+                shape = (image.width, image.height, 1)
+        elif class_type == "ImageResize+":
+            width, height, batch = self.image_shape(prompt, inputs["image"][0], shapes)
+            if inputs.get("keep_proportion"):
+                scale = min(inputs["width"] / width, inputs["height"] / height)
+                shape = (round(width * scale), round(height * scale), batch)
+            else:
+                shape = (inputs["width"], inputs["height"], batch)
+        elif class_type == "RepeatLatentBatch":
+            width, height, batch = self.image_shape(
+                prompt, inputs["samples"][0], shapes
+            )
+            shape = (width, height, batch * inputs["amount"])
+        elif class_type == "KSampler":
+            shape = self.image_shape(prompt, inputs["latent_image"][0], shapes)
+        elif linked:
+            shape = self.image_shape(prompt, linked[0], shapes)
+        else:
+            shape = (512, 512, 1)
+
+        shapes[node_id] = shape
+        return shape
+
+    def image_pixels(self, width, height):
+        if (width, height) not in self.pixels:
+            gradient = Image.linear_gradient("L")
+            image = Image.merge(
+                "RGB",
+                [
+                    gradient.resize((width, height)),
+                    gradient.rotate(90).resize((width, height)),
+                    gradient.rotate(180).resize((width, height)),
+                ],
+            )
+            self.pixels[(width, height)] = image
+        return self.pixels[(width, height)]
+
+    def preview_bytes(self, width, height):
+        size = (max(width // 8, 1), max(height // 8, 1))
+        if size not in self.previews:
+            buffer = io.BytesIO()
+            self.image_pixels(*size).save(buffer, format="JPEG", quality=60)
+            self.previews[size] = buffer.getvalue()
+        return self.previews[size]
+
+    def output_path(self, prefix, extension):
+        self.counter += 1
+        path = os.path.join(
+            self.output_directory, f"{prefix}_{self.counter:05}_.{extension}"
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    async def send(self, client_id, event, data):
+        ws = self.clients.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_str(json.dumps({"type": event, "data": data}))
+
+    async def send_bytes(self, client_id, data):
+        ws = self.clients.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_bytes(data)
+
+    async def sleep(self, class_type):
+        await asyncio.sleep(
+            self.latencies.get(class_type, DEFAULT_LATENCY) * self.latency_scale
+        )
+
+    async def run_node(self, client_id, prompt_id, prompt, node_id, shapes):
+        node = prompt[node_id]
+        inputs = node.get("inputs", {})
+        class_type = node["class_type"]
+
+        if class_type == "KSampler":
+            width, height, _ = self.image_shape(prompt, node_id, shapes)
+            steps = inputs.get("steps", 1)
+            for step in range(1, steps + 1):
+                if self.interrupted:
+                    return None
+                await self.sleep(class_type)
+                await self.send(
+                    client_id,
+                    "progress",
+                    {
+                        "value": step,
+                        "max": steps,
+                        "prompt_id": prompt_id,
+                        "node": node_id,
+                    },
+                )
+                if self.preview_method != "none":
+                    await self.send_bytes(
+                        client_id,
+                        struct.pack(">II", PREVIEW_IMAGE_EVENT, 1)
+                        + self.preview_bytes(width, height),
+                    )
+            return None
+
+        await self.sleep(class_type)
+
+        if class_type == "SaveImageWebsocketRaw":
+            width, height, batch = self.image_shape(prompt, node_id, shapes)
+            pixels = self.image_pixels(width, height).tobytes()
+            for index in range(batch):
+                await self.send_bytes(
+                    client_id,
+                    struct.pack(">IIII", RAW_IMAGE_EVENT, width, height, index)
+                    + pixels,
+                )
+            return {}
+        if class_type == "SaveImage":
+            width, height, batch = self.image_shape(prompt, node_id, shapes)
+            images = []
+            for _ in range(batch):
+                path = self.output_path(inputs["filename_prefix"], "png")
+                self.image_pixels(width, height).save(path, compress_level=1)
+                images.append(
+                    {
+                        "filename": os.path.basename(path),
+                        "subfolder": os.path.dirname(inputs["filename_prefix"]),
+                        "type": "output",
+                    }
+                )
+            return {"images": images}
+        if class_type == "IPAdapterSaveEmbeds":
+            path = self.output_path(inputs["filename_prefix"], "ipadpt")
+            with open(path, "wb") as f:
+                f.write(os.urandom(257 * 1280 * 2))
+            return {}
+        if class_type == "PreviewImage":
+            return {"images": []}
+        return None
+
+    async def execute(self, number, prompt_id, prompt, client_id):
+        messages = []
+
+        async def status(event, data):
+            messages.append([event, data])
+            await self.send(client_id, event, data)
+
+        await status("execution_start", {"prompt_id": prompt_id})
+        self.apply_free(prompt)
+        order = self.execution_order(prompt)
+        signatures = {}
+        for node_id in order:
+            self.signature(prompt, node_id, signatures)
+        cached = [
+            node_id
+            for node_id in order
+            if prompt[node_id]["class_type"] not in ALWAYS_RUN_NODES
+            and self.executed.get(node_id) == signatures[node_id]
+        ]
+        await status("execution_cached", {"nodes": cached, "prompt_id": prompt_id})
+
+        shapes = {}
+        outputs = {}
+        executed = []
+        result = "execution_success"
+        for node_id in order:
+            if node_id in cached:
+                continue
+            class_type = prompt[node_id]["class_type"]
+            details = {
+                "prompt_id": prompt_id,
+                "node_id": node_id,
+                "node_type": class_type,
+                "executed": list(executed),
+            }
+            if self.interrupted:
+                await status("execution_interrupted", details)
+                result = None
+                break
+
+            await self.send(
+                client_id, "executing", {"node": node_id, "prompt_id": prompt_id}
+            )
+            if class_type == self.fail_node_class:
+                await status(
+                    "execution_error",
+                    {
+                        **details,
+                        "exception_message": "Failure injected by the stand-in server",
+                        "exception_type": "RuntimeError",
+                        "traceback": [],
+                    },
+                )
+                result = None
+                break
+
+            output = await self.run_node(client_id, prompt_id, prompt, node_id, shapes)
+            if self.interrupted:
+                await status("execution_interrupted", details)
+                result = None
+                break
+            if output:
+                outputs[node_id] = output
+            executed.append(node_id)
+            self.executed[node_id] = signatures[node_id]
+
+        if result:
+            messages.append([result, {"prompt_id": prompt_id}])
+            await self.send(
+                client_id, "executing", {"node": None, "prompt_id": prompt_id}
+            )
+
+        self.history[prompt_id] = {
+            "prompt": [number, prompt_id, prompt, {"client_id": client_id}, []],
+            "outputs": outputs,
+            "status": {
+                "status_str": "success" if result else "error",
+                "completed": bool(result),
+                "messages": messages,
+            },
+        }
+
+    async def worker(self):
+        while True:
+            if not self.queue:
+                self.queue_changed.clear()
+                await self.queue_changed.wait()
+                continue
+
+            self.running = self.queue.pop(0)
+            self.interrupted = False
+            number, prompt_id, prompt, client_id = self.running
+            start = time.time()
+            try:
+                await self.execute(number, prompt_id, prompt, client_id)
+            except Exception as e:
+                print(f"Prompt {prompt_id} failed: {e}")
+            finally:
+                self.running = None
+                self.interrupted = False
+            print(f"Prompt executed in {time.time() - start:.2f} seconds")
+
+
+async def main(args):
+    server = FakeComfyUI(args)
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/prompt", server.post_prompt)
+    app.router.add_get("/history", server.get_history)
+    app.router.add_get("/history/{prompt_id}", server.get_history)
+    app.router.add_get("/queue", server.get_queue)
+    app.router.add_post("/queue", server.post_queue)
+    app.router.add_post("/interrupt", server.post_interrupt)
+    app.router.add_post("/free", server.post_free)
+    app.router.add_get("/ws", server.websocket)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, args.listen, args.port).start()
+    # The line the bridge waits for when it starts ComfyUI itself
+    print(f"To see the GUI go to: http://{args.listen}:{args.port}", flush=True)
+    await server.worker()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stand-in ComfyUI server")
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--output-directory", default="/tmp/outputs")
+    parser.add_argument("--input-directory", default="/tmp/inputs")
+    parser.add_argument("--preview-method", default="none")
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="CLASS=SECONDS",
+        help="Seconds a node class takes, per step for KSampler",
+    )
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="Multiply every node latency by this",
+    )
+    parser.add_argument(
+        "--fail-node-class",
+        default=None,
+        help="Fail prompts with an execution_error when they reach this class",
+    )
+    # Accept the rest of ComfyUI's flags, such as --gpu-only, and ignore them
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
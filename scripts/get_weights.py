@@ -1,41 +1,138 @@
 #!/usr/bin/env python3
+import argparse
 import sys
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 from weights_downloader import WeightsDownloader
 
-def download_weight_files(weight_files):
-    wd = WeightsDownloader()
-    for weight_file in weight_files:
-        wd.download_weights(weight_file)
-
-def extract_weights_from_workflow(workflow_path):
-    with open(workflow_path, 'r') as f:
-        workflow = json.load(f)
-    weights_to_download = []
-    for node in workflow.values():
-        if "inputs" in node:
-            for input in node["inputs"].values():
-                if isinstance(input, str) and input.endswith(tuple(WeightsDownloader.supported_filetypes)):
-                    weights_to_download.append(input)
-    return list(set(weights_to_download))
-
-def main(filenames):
-    weight_files = []
+LOCKFILE_VERSION = 1
+# Assumed download speed for --dry-run estimates, in MB/s
+DEFAULT_BANDWIDTH = 100
+
+def is_lockfile(data):
+    return isinstance(data, dict) and data.get('version') == LOCKFILE_VERSION and 'weights' in data
+
+def workflow_weights(comfyUI, workflow):
+    # The same resolution the predictor runs before a prompt, including the
+    # weights that IPAdapter presets and controlnet preprocessors imply
+    return comfyUI.collect_weights(workflow)
+
+def preset_weights(comfyUI, presets):
+    # Imported here, the predictor needs cog and the workflow templates
+    import predict
+
+    if presets == 'all':
+        presets = predict.MODELS
+    else:
+        presets = [p.strip() for p in presets.split(',') if p.strip()]
+    weights = []
+    for preset in presets:
+        if preset not in predict.MODELS:
+            raise ValueError(f"Unknown preset {preset}, expected one of {', '.join(predict.MODELS)}")
+        for workflow in predict.preset_workflows(preset):
+            weights.extend(workflow_weights(comfyUI, workflow))
+    return weights
+
+def resolve_weights(comfyUI, filenames, presets=None):
+    weights = []
     for filename in filenames:
         if filename.endswith('.txt'):
             with open(filename, 'r') as f:
-                weight_files.extend(f.read().splitlines())
+                weights.extend(line.strip() for line in f if line.strip())
         elif filename.endswith('.json'):
-            weight_files.extend(extract_weights_from_workflow(filename))
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            if is_lockfile(data):
+                weights.extend(weight['name'] for weight in data['weights'])
+            else:
+                weights.extend(workflow_weights(comfyUI, data))
         else:
-            weight_files.append(filename)
-    download_weight_files(weight_files)
+            weights.append(filename)
+    if presets:
+        weights.extend(preset_weights(comfyUI, presets))
+    # Kept in order, the first workflow's weights download first
+    return list(dict.fromkeys(weights))
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python get_weights.py <filename> [<filename> ...] or python get_weights.py <weights.txt> or python get_weights.py <workflow.json>")
+def weight_size(wd, weight_str):
+    # Stored weights report the size of their files, the rest the size of
+    # their archive. Returns (bytes, stored).
+    weight = wd.weights_map[weight_str]
+    ref = wd.store.lookup(weight.url)
+    if ref is not None:
+        return sum(file['size'] for file in ref['files']), True
+    response = wd.store.http.head(weight.url, allow_redirects=True)
+    response.raise_for_status()
+    return int(response.headers.get('Content-Length', 0)), False
+
+def lock_entry(wd, weight_str, size=None):
+    weight = wd.weights_map[weight_str]
+    entry = {'name': weight_str, 'type': weight.type, 'url': weight.url, 'dest': weight.dest}
+    ref = wd.store.lookup(weight.url)
+    if ref is not None:
+        entry['bytes'] = sum(file['size'] for file in ref['files'])
+        entry['files'] = [{'path': f['path'], 'sha256': f['sha256'], 'size': f['size']} for f in ref['files']]
+    elif size is not None:
+        entry['bytes'] = size
+    return entry
+
+def write_lockfile(path, entries):
+    with open(path, 'w') as f:
+        json.dump({'version': LOCKFILE_VERSION, 'weights': entries}, f, indent=2)
+        f.write('\n')
+    print(f"Wrote {len(entries)} weights to {path}")
+
+def dry_run(wd, weights, concurrency, bandwidth):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        sizes = dict(zip(weights, pool.map(lambda w: weight_size(wd, w), weights)))
+    missing_bytes = 0
+    for weight_str, (size, stored) in sizes.items():
+        if not stored:
+            missing_bytes += size
+        print(f"{'✅' if stored else '⏳'} {weight_str}, {size / (1024 * 1024):.2f}MB")
+    total_bytes = sum(size for size, _ in sizes.values())
+    missing = sum(1 for _, stored in sizes.values() if not stored)
+    print(
+        f"{len(weights)} weights, {total_bytes / (1024 ** 3):.2f}GB in total. "
+        f"{missing} to download, {missing_bytes / (1024 ** 3):.2f}GB, "
+        f"about {missing_bytes / (1024 * 1024) / bandwidth:.0f}s at {bandwidth}MB/s"
+    )
+    return {weight_str: size for weight_str, (size, _) in sizes.items()}
+
+def main(args):
+    from helpers.comfyui import ComfyUI
+
+    wd = WeightsDownloader(max_concurrent_downloads=args.concurrency)
+    comfyUI = ComfyUI('127.0.0.1:8188', weights_downloader=wd)
+    weights = resolve_weights(comfyUI, args.filenames, args.presets)
+
+    unknown = [w for w in weights if w not in wd.weights_map]
+    if unknown:
+        print(f"Unavailable weights: {', '.join(unknown)}")
+        print("View the list of available weights: https://github.com/fofr/cog-comfyui/blob/main/supported_weights.md")
         sys.exit(1)
-    filenames = sys.argv[1:]
-    main(filenames)
+
+    if args.dry_run:
+        sizes = dry_run(wd, weights, args.concurrency, args.bandwidth)
+    else:
+        sizes = {}
+        comfyUI.wait_for_weights(wd.download_plan(weights))
+
+    if args.lockfile:
+        write_lockfile(args.lockfile, [lock_entry(wd, w, sizes.get(w)) for w in weights])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download the weights that workflows, weight lists and presets need, such as while baking an image"
+    )
+    parser.add_argument('filenames', nargs='*', help="Weight names, weights.txt lists, workflow API JSON or lockfiles")
+    parser.add_argument('--presets', help="Predictor presets to include, comma separated, or 'all'")
+    parser.add_argument('--concurrency', type=int, default=WeightsDownloader.max_concurrent_downloads, help="Weights to download at once")
+    parser.add_argument('--dry-run', action='store_true', help="List the weights with their sizes and estimate the download, without downloading")
+    parser.add_argument('--bandwidth', type=float, default=DEFAULT_BANDWIDTH, help="Download speed in MB/s assumed by --dry-run")
+    parser.add_argument('--lockfile', help="Write the resolved weights, with their hashes once stored, to this JSON file")
+    args = parser.parse_args()
+    if not args.filenames and not args.presets:
+        parser.error("give at least one weight, weights.txt, workflow.json or --presets")
+    main(args)
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+import time
+
+from weights_store import write_json
+
+# Bytes of weights to keep on disk, 0 keeps everything
+WEIGHTS_CACHE_GB = float(os.environ.get("WEIGHTS_CACHE_GB", "0"))
+# Weights used this recently are never evicted, a prompt may be loading them
+MIN_EVICTION_AGE = 300
+
+
+class WeightsCache:
+    # Keeps the weights store under a byte budget. Every weight a workflow
+    # asks for is marked as used. Before a download that would go over the
+    # budget, the least recently used weights are evicted, except pinned
+    # ones (the predictor's own templates) and recently used ones.
+    # Last-use times survive restarts in usage.json next to the store.
+    def __init__(self, store, budget_bytes=WEIGHTS_CACHE_GB * 1024**3):
+        self.store = store
+        self.budget_bytes = int(budget_bytes)
+        self.lock = threading.Lock()
+        self.usage_path = os.path.join(store.root, "usage.json")
+        self.last_used = self.load_usage()
+        self.pinned = set()
+        # Sizes of downloads that have made room but are not stored yet
+        self.reserved = {}
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.over_budget = 0
+
+    def load_usage(self):
+        try:
+            with open(self.usage_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_usage(self):
+        # A copy, touch() may add to last_used while it is written
+        write_json(self.usage_path, dict(self.last_used))
+
+    def touch(self, url):
+        with self.lock:
+            self.last_used[url] = time.time()
+
+    def pin(self, urls):
+        self.pinned.update(urls)
+
+    def make_room(self, needed_bytes, url):
+        # Called before url's archive is downloaded, with the bytes it needs
+        if not self.budget_bytes:
+            return
+        with self.lock:
+            used = self.store.used_bytes() + sum(self.reserved.values())
+            if used + needed_bytes > self.budget_bytes:
+                self.evict(used + needed_bytes - self.budget_bytes, url)
+            self.reserved[url] = needed_bytes
+            self.save_usage()
+
+    def release(self, url):
+        # The download is stored, or failed
+        with self.lock:
+            self.reserved.pop(url, None)
+
+    def evict(self, bytes_to_free, url):
+        now = time.time()
+        candidates = []
+        for ref in self.store.refs():
+            ref_url = ref["url"]
+            last_used = self.last_used.get(ref_url, ref.get("stored_at", 0))
+            if (
+                ref_url == url
+                or ref_url in self.pinned
+                or now - last_used < MIN_EVICTION_AGE
+            ):
+                continue
+            candidates.append((last_used, ref_url))
+
+        freed = 0
+        for _, ref_url in sorted(candidates):
+            if freed >= bytes_to_free:
+                break
+            removed = self.store.remove(ref_url)
+            freed += removed
+            self.last_used.pop(ref_url, None)
+            self.evictions += 1
+            self.evicted_bytes += removed
+            print(f"Evicted {ref_url}, freed {removed / (1024 * 1024):.2f}MB")
+
+        if freed < bytes_to_free:
+            # The download goes ahead, the disk is the hard limit
+            self.over_budget += 1
+            print(
+                f"Weights cache over budget by {(bytes_to_free - freed) / (1024 * 1024):.2f}MB, nothing else can be evicted"
+            )
+
+    def stats(self):
+        used = self.store.used_bytes()
+        return {
+            "budget_bytes": self.budget_bytes,
+            "used_bytes": used,
+            "used_fraction": (
+                round(used / self.budget_bytes, 3) if self.budget_bytes else None
+            ),
+            "weights": len(self.store.ref_names()),
+            "pinned": len(self.pinned),
+            "evictions": self.evictions,
+            "evicted_bytes": self.evicted_bytes,
+            "over_budget": self.over_budget,
+        }
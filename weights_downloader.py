@@ -1,12 +1,61 @@
-import subprocess
+import threading
 import time
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
 
+from weights_cache import WeightsCache
 from weights_manifest import WeightsManifest
+from weights_store import WeightsStore
 
 BASE_URL = "https://weights.replicate.delivery/default/comfy-ui"
 
 
+def weight_dest(weight_str, dest):
+    # Weights named with a subfolder are extracted into it
+    if "/" in weight_str:
+        return os.path.join(dest, weight_str.rsplit("/", 1)[0])
+    return dest
+
+
+class DownloadPlan:
+    # Weights that a workflow needs, resolved up front and fetched concurrently.
+    # Futures are shared with any other plan already fetching the same weight.
+    def __init__(self, futures):
+        self.futures = futures
+        self.start = time.time()
+
+    def __contains__(self, weight_str):
+        return weight_str in self.futures
+
+    def wait(self, weights=None):
+        for weight_str in weights or self.futures:
+            self.futures[weight_str].result()
+            print(f"✅ {weight_str}")
+
+    def done(self):
+        return all(future.done() for future in self.futures.values())
+
+    def report(self):
+        results = [
+            future.result()
+            for future in self.futures.values()
+            if future.done() and not future.exception()
+        ]
+        downloaded = [r for r in results if r["downloaded"]]
+        total_bytes = sum(r["bytes"] for r in downloaded)
+        elapsed_time = time.time() - self.start
+        return {
+            "weights": len(self.futures),
+            "downloaded": len(downloaded),
+            "bytes": total_bytes,
+            "seconds": elapsed_time,
+            "throughput_mb_s": (
+                total_bytes / (1024 * 1024) / elapsed_time if elapsed_time else 0
+            ),
+            "files": results,
+        }
+
+
 class WeightsDownloader:
     supported_filetypes = [
         ".ckpt",
@@ -17,56 +66,160 @@ class WeightsDownloader:
         ".onnx",
         ".torchscript",
     ]
+    max_concurrent_downloads = 4
 
-    def __init__(self):
+    def __init__(self, max_concurrent_downloads=max_concurrent_downloads):
         self.weights_manifest = WeightsManifest()
-        self.weights_map = self.weights_manifest.weights_map
+        self.store = WeightsStore()
+        self.cache = WeightsCache(self.store)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_downloads, thread_name_prefix="weights"
+        )
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self._present_weights = None
+
+    @property
+    def weights_map(self):
+        return self.weights_manifest.weights_map
+
+    @property
+    def present_weights(self):
+        if self._present_weights is None:
+            self._present_weights = self.build_presence_index()
+        return self._present_weights
+
+    def build_presence_index(self):
+        # Manifest weights with a sidecar in the store, from one listdir.
+        # Kept current as downloads finish, so most checks are set lookups.
+        ref_names = self.store.ref_names()
+        return {
+            weight_str
+            for weight_str, weight in self.weights_map.items()
+            if self.store.ref_name(weight.url) in ref_names
+        }
+
+    def is_present(self, weight_str, url, dest):
+        # A file in the model directory is not enough, it may be a truncated
+        # extraction. The weight must be stored with intact blobs, and it is
+        # linked into place again if the link has gone. That is checked on
+        # disk once, until the store removes the weight.
+        if weight_str in self.weights_map and weight_str not in self.present_weights:
+            return False
+        dest = weight_dest(weight_str, dest)
+        if (url, dest) in self.store.verified:
+            return True
+        ref = self.store.lookup(url)
+        if ref is None:
+            self.present_weights.discard(weight_str)
+            return False
+        if not self.store.is_materialised(ref, dest):
+            self.store.materialise(ref, dest)
+        self.store.verified.add((url, dest))
+        return True
 
     def get_weights_by_type(self, type):
         return self.weights_manifest.get_weights_by_type(type)
 
     def download_weights(self, weight_str):
-        if weight_str in self.weights_map:
-            self.download_if_not_exists(
-                weight_str,
-                self.weights_map[weight_str]["url"],
-                self.weights_map[weight_str]["dest"],
-            )
-        else:
+        return self.download_weights_async(weight_str).result()
+
+    def check_available(self, weight_str):
+        if weight_str not in self.weights_map:
             raise ValueError(
                 f"{weight_str} unavailable. View the list of available weights: https://github.com/fofr/cog-comfyui/blob/main/supported_weights.md"
             )
 
+    def download_weights_async(self, weight_str):
+        self.check_available(weight_str)
+        return self.download_if_not_exists_async(
+            weight_str,
+            self.weights_map[weight_str].url,
+            self.weights_map[weight_str].dest,
+        )
+
+    def download_plan(self, weights):
+        # Resolve every weight before fetching any, so an unknown weight fails
+        # the plan without leaving half of it downloading in the background
+        for weight_str in weights:
+            self.check_available(weight_str)
+
+        futures = {
+            weight_str: self.download_weights_async(weight_str)
+            for weight_str in dict.fromkeys(weights)
+        }
+        return DownloadPlan(futures)
+
     def download_torch_checkpoints(self):
-        self.download_if_not_exists(
-            "mobilenet_v2-b0353104.pth",
-            f"{BASE_URL}/custom_nodes/comfyui_controlnet_aux/mobilenet_v2-b0353104.pth.tar",
-            "/root/.cache/torch/hub/checkpoints/",
+        # Every boot needs it, and a running server may have it open
+        url = f"{BASE_URL}/custom_nodes/comfyui_controlnet_aux/mobilenet_v2-b0353104.pth.tar"
+        self.cache.pin([url])
+        return self.download_if_not_exists_async(
+            "mobilenet_v2-b0353104.pth", url, "/root/.cache/torch/hub/checkpoints/"
         )
 
     def download_if_not_exists(self, weight_str, url, dest):
-        if not os.path.exists(f"{dest}/{weight_str}"):
-            self.download(weight_str, url, dest)
+        return self.download_if_not_exists_async(weight_str, url, dest).result()
 
-    def download(self, weight_str, url, dest):
-        if "/" in weight_str:
-            subfolder = weight_str.rsplit("/", 1)[0]
-            dest = os.path.join(dest, subfolder)
-            os.makedirs(dest, exist_ok=True)
+    def pin(self, weight_strs):
+        # Never evicted from the weights cache
+        self.cache.pin(
+            self.weights_map[weight_str].url
+            for weight_str in weight_strs
+            if weight_str in self.weights_map
+        )
+
+    def download_if_not_exists_async(self, weight_str, url, dest):
+        self.cache.touch(url)
+        with self.in_flight_lock:
+            if weight_str in self.in_flight:
+                return self.in_flight[weight_str]
+
+            if self.is_present(weight_str, url, dest):
+                future = Future()
+                future.set_result(
+                    {
+                        "weight": weight_str,
+                        "downloaded": False,
+                        "bytes": 0,
+                        "seconds": 0.0,
+                    }
+                )
+                return future
+
+            future = self.executor.submit(self.download, weight_str, url, dest)
+            self.in_flight[weight_str] = future
 
+        future.add_done_callback(lambda _: self.forget_in_flight(weight_str))
+        return future
+
+    def forget_in_flight(self, weight_str):
+        with self.in_flight_lock:
+            self.in_flight.pop(weight_str, None)
+
+    def download(self, weight_str, url, dest):
+        dest = weight_dest(weight_str, dest)
         print(f"⏳ Downloading {weight_str} to {dest}")
         start = time.time()
-        subprocess.check_call(
-            ["pget", "--log-level", "warn", "-xf", url, dest], close_fds=False
-        )
-        elapsed_time = time.time() - start
         try:
-            file_size_bytes = os.path.getsize(
-                os.path.join(dest, os.path.basename(weight_str))
-            )
-            file_size_megabytes = file_size_bytes / (1024 * 1024)
-            print(
-                f"⌛️ Downloaded {weight_str} in {elapsed_time:.2f}s, size: {file_size_megabytes:.2f}MB"
+            ref, downloaded_bytes = self.store.fetch(
+                url, dest, reserve=lambda size: self.cache.make_room(size, url)
             )
-        except FileNotFoundError:
-            print(f"⌛️ Downloaded {weight_str} in {elapsed_time:.2f}s")
+        finally:
+            self.cache.release(url)
+        elapsed_time = time.time() - start
+        self.present_weights.add(weight_str)
+        result = {
+            "weight": weight_str,
+            "downloaded": True,
+            "bytes": sum(file["size"] for file in ref["files"]),
+            "seconds": elapsed_time,
+        }
+        file_size_megabytes = result["bytes"] / (1024 * 1024)
+        downloaded_megabytes = downloaded_bytes / (1024 * 1024)
+        print(
+            f"⌛️ Downloaded {weight_str} in {elapsed_time:.2f}s, size: {file_size_megabytes:.2f}MB, {downloaded_megabytes / max(elapsed_time, 1e-6):.2f}MB/s"
+        )
+        if self.cache.budget_bytes:
+            print(f"Weights cache: {self.cache.stats()}")
+        return result
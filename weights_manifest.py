@@ -1,21 +1,111 @@
-import json
+import bisect
+import marshal
 import os
+import sys
 
 BASE_URL = "https://weights.replicate.delivery/default/comfy-ui"
 BASE_PATH = "ComfyUI/models"
+WEIGHTS_MANIFEST_PATH = "weights.json"
+# Precompiled form of the manifest, rebuilt whenever weights.json is newer
+# or the controlnet aux models compiled into it have changed
+WEIGHTS_INDEX_PATH = "weights.index"
+WEIGHTS_INDEX_VERSION = 1
 
+import helpers.ComfyUI_Controlnet_Aux
 from helpers.ComfyUI_Controlnet_Aux import ComfyUI_Controlnet_Aux
 
+WEIGHTS_INDEX_SOURCES = [
+    WEIGHTS_MANIFEST_PATH,
+    helpers.ComfyUI_Controlnet_Aux.__file__,
+]
+
+CONTROLNET_AUX_TYPE = "CONTROLNET_AUX"
+
+
+class WeightsCategory:
+    # Shared by every weight of a type, so the URL and destination prefixes
+    # are stored once per category rather than once per weight
+    __slots__ = ("type", "url_path", "dest")
+
+    def __init__(self, type, url_path, dest):
+        self.type = sys.intern(type)
+        self.url_path = sys.intern(url_path)
+        self.dest = sys.intern(dest)
+
+
+class Weight:
+    __slots__ = ("name", "category")
+
+    def __init__(self, name, category):
+        self.name = name
+        self.category = category
+
+    @property
+    def type(self):
+        return self.category.type
+
+    @property
+    def url(self):
+        return f"{BASE_URL}/{self.category.url_path}/{self.name}.tar"
+
+    @property
+    def dest(self):
+        return self.category.dest
+
+
+class WeightsMap:
+    # Maps a weight name to its category, Weight records are made on lookup
+    def __init__(self, categories):
+        self.categories = categories
+
+    def __contains__(self, name):
+        return name in self.categories
+
+    def __getitem__(self, name):
+        return Weight(name, self.categories[name])
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+    def keys(self):
+        return self.categories.keys()
+
+    def values(self):
+        return (Weight(name, category) for name, category in self.categories.items())
+
+    def items(self):
+        return ((weight.name, weight) for weight in self.values())
+
+
 class WeightsManifest:
+    # Nothing is read until a weight is first looked up
     def __init__(self):
-        self.weights_manifest = self._load_weights_manifest()
-        self.weights_map = self._initialize_weights_map()
+        self._weights_map = None
+        self._sorted_names = None
+
+    @property
+    def weights_map(self):
+        if self._weights_map is None:
+            self._weights_map = self._load_weights_map()
+        return self._weights_map
+
+    def _load_weights_map(self):
+        index = self._load_index()
+        if index is None:
+            index = self._compile_index(self._load_local_manifest())
+            self._save_index(index)
 
-    def _load_weights_manifest(self):
-        return self._load_local_manifest()
+        categories = {}
+        for category, names in zip(index["categories"], index["names"]):
+            categories.update(dict.fromkeys(names, WeightsCategory(*category)))
+        return WeightsMap(categories)
 
     def _load_local_manifest(self):
-        WEIGHTS_MANIFEST_PATH = "weights.json"
+        import json
+
         if os.path.exists(WEIGHTS_MANIFEST_PATH):
             with open(WEIGHTS_MANIFEST_PATH, "r") as f:
                 return json.load(f)
@@ -23,22 +113,84 @@ class WeightsManifest:
             print("Local weights manifest file does not exist.")
             return {}
 
-    def _generate_weights_map(self, keys, dest):
+    def _compile_index(self, manifest):
+        categories = []
+        names = []
+        for key in manifest.keys():
+            if key.isupper():
+                categories.append((key, key.lower(), f"{BASE_PATH}/{key.lower()}"))
+                names.append(list(manifest[key]))
+
+        # Controlnet aux weights get a category per destination repository
+        aux_categories = {}
+        for name, repository in ComfyUI_Controlnet_Aux.models().items():
+            if repository not in aux_categories:
+                aux_categories[repository] = len(categories)
+                categories.append(
+                    (
+                        CONTROLNET_AUX_TYPE,
+                        "custom_nodes/comfyui_controlnet_aux",
+                        f"ComfyUI/custom_nodes/comfyui_controlnet_aux/ckpts/{repository}",
+                    )
+                )
+                names.append([])
+            names[aux_categories[repository]].append(name)
+
         return {
-            key: {
-                "url": f"{BASE_URL}/{dest}/{key}.tar",
-                "dest": f"{BASE_PATH}/{dest}",
-            }
-            for key in keys
+            "version": WEIGHTS_INDEX_VERSION,
+            "categories": categories,
+            "names": names,
         }
 
-    def _initialize_weights_map(self):
-        weights_map = {}
-        for key in self.weights_manifest.keys():
-            if key.isupper():
-                weights_map.update(
-                    self._generate_weights_map(self.weights_manifest[key], key.lower())
-                )
+    def _load_index(self):
+        try:
+            index_mtime = os.path.getmtime(WEIGHTS_INDEX_PATH)
+            if any(
+                index_mtime < os.path.getmtime(source)
+                for source in WEIGHTS_INDEX_SOURCES
+            ):
+                return None
+            with open(WEIGHTS_INDEX_PATH, "rb") as f:
+                index = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if index.get("version") != WEIGHTS_INDEX_VERSION:
+            return None
+        return index
+
+    def _save_index(self, index):
+        if not os.path.exists(WEIGHTS_MANIFEST_PATH):
+            return
+        try:
+            with open(f"{WEIGHTS_INDEX_PATH}.tmp", "wb") as f:
+                marshal.dump(index, f)
+            os.replace(f"{WEIGHTS_INDEX_PATH}.tmp", WEIGHTS_INDEX_PATH)
+        except OSError as e:
+            print(f"Could not write weights index: {e}")
+
+    def get_weights_by_type(self, type):
+        type = type.upper()
+        return [
+            name
+            for name, category in self.weights_map.categories.items()
+            if category.type == type
+        ]
+
+    def get_weights_by_prefix(self, prefix):
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.weights_map)
+        start = bisect.bisect_left(self._sorted_names, prefix)
+        matches = []
+        for name in self._sorted_names[start:]:
+            if not name.startswith(prefix):
+                break
+            matches.append(name)
+        return matches
+
 
-        weights_map.update(ComfyUI_Controlnet_Aux.weights_map(BASE_URL))
-        return weights_map
+if __name__ == "__main__":
+    # Precompile the index at image build time
+    manifest = WeightsManifest()
+    manifest._save_index(manifest._compile_index(manifest._load_local_manifest()))
+    print(f"Wrote {WEIGHTS_INDEX_PATH}")
@@ -0,0 +1,327 @@
+import collections
+import errno
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+WEIGHTS_STORE_DIR = os.environ.get("WEIGHTS_STORE_DIR", "weights-store")
+# Archives are fetched in ranges of this size over several connections, and
+# a download that is cut short resumes from the ranges it had finished
+CHUNK_SIZE = 64 * 1024 * 1024
+CONNECTIONS = 8
+CHUNK_RETRIES = 3
+READ_SIZE = 8 * 1024 * 1024
+
+
+def write_json(path, data):
+    # Readers see the old file or the new one, never half of one
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class WeightsStore:
+    # Weights stored by content. Each file of a weight's archive becomes a
+    # blob named by its sha256, so files shared by several weights are
+    # stored once. A sidecar per weight lists its files with their hashes
+    # and sizes. Hashes are checked once, when the blob is written. After
+    # that a weight is present if its sidecar exists and its blobs have the
+    # recorded sizes. The model directories hold hard links to the blobs, or
+    # symlinks where the store is on another filesystem.
+    # Blobs and sidecars are written to temporary names and renamed into
+    # place, so a killed boot never leaves a file that looks complete.
+    def __init__(self, root=WEIGHTS_STORE_DIR):
+        self.root = root
+        self.blobs_dir = os.path.join(root, "blobs")
+        self.refs_dir = os.path.join(root, "refs")
+        self.partial_dir = os.path.join(root, "partial")
+        for directory in [self.blobs_dir, self.refs_dir, self.partial_dir]:
+            os.makedirs(directory, exist_ok=True)
+        self.http = requests.Session()
+        self.state_lock = threading.Lock()
+        # Blobs written or found for a weight whose sidecar is not written
+        # yet. No sidecar names them, so remove() must not take them.
+        self.blobs_lock = threading.Lock()
+        self.pending_blobs = collections.Counter()
+        # (url, dest) pairs known to be stored intact and linked into dest,
+        # so later checks need no filesystem calls. remove() drops them.
+        self.verified = set()
+
+    def ref_name(self, url):
+        return f"{hashlib.sha256(url.encode()).hexdigest()[:32]}.json"
+
+    def ref_names(self):
+        # One listdir to tell which weights might be stored
+        return set(os.listdir(self.refs_dir))
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256)
+
+    def read_ref(self, url):
+        try:
+            with open(os.path.join(self.refs_dir, self.ref_name(url))) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, url):
+        # The weight's sidecar if all of its blobs are intact, else None
+        ref = self.read_ref(url)
+        if ref is None:
+            return None
+        for file in ref["files"]:
+            try:
+                if os.path.getsize(self.blob_path(file["sha256"])) != file["size"]:
+                    return None
+            except OSError:
+                return None
+        return ref
+
+    # Downloading
+
+    def fetch(self, url, dest, reserve=None):
+        # Downloads and stores the weight at url, then links it into dest.
+        # reserve(bytes) is called before the download starts, with twice
+        # the archive's size: the archive and the blobs stored from it are
+        # both on disk until the archive is removed. Returns its sidecar
+        # and the bytes downloaded.
+        archive_path = os.path.join(self.partial_dir, self.ref_name(url)[:-5] + ".tar")
+        downloaded = self.download_archive(url, archive_path, reserve)
+        ref = self.store_archive(url, archive_path)
+        os.remove(archive_path)
+        self.materialise(ref, dest)
+        self.verified.add((url, dest))
+        return ref, downloaded
+
+    def download_archive(self, url, path, reserve=None):
+        response = self.http.head(url, allow_redirects=True)
+        response.raise_for_status()
+        size = int(response.headers.get("Content-Length", 0))
+        if reserve:
+            reserve(2 * size)
+        if response.headers.get("Accept-Ranges") != "bytes" or not size:
+            return self.download_stream(url, path)
+
+        state_path = f"{path}.json"
+        state = None
+        if os.path.exists(path):
+            try:
+                with open(state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = None
+        if state is None or state["url"] != url or state["size"] != size:
+            state = {"url": url, "size": size, "done": []}
+            with open(path, "wb") as f:
+                f.truncate(size)
+            write_json(state_path, state)
+
+        chunks = [
+            (start, min(start + CHUNK_SIZE, size))
+            for start in range(0, size, CHUNK_SIZE)
+        ]
+        todo = [i for i in range(len(chunks)) if i not in set(state["done"])]
+        if len(todo) < len(chunks):
+            print(f"Resuming {url}, {len(chunks) - len(todo)}/{len(chunks)} chunks")
+
+        def fetch_chunk(i):
+            self.download_range(url, path, *chunks[i])
+            with self.state_lock:
+                state["done"].append(i)
+                write_json(state_path, state)
+
+        with ThreadPoolExecutor(max_workers=CONNECTIONS) as pool:
+            for future in [pool.submit(fetch_chunk, i) for i in todo]:
+                future.result()
+
+        os.remove(state_path)
+        return sum(chunks[i][1] - chunks[i][0] for i in todo)
+
+    def download_range(self, url, path, start, end):
+        for attempt in range(CHUNK_RETRIES):
+            try:
+                with self.http.get(
+                    url, headers={"Range": f"bytes={start}-{end - 1}"}, stream=True
+                ) as response:
+                    response.raise_for_status()
+                    # A 200 is the whole archive, the server ignored the range
+                    if response.status_code != 206:
+                        raise IOError(f"Range request returned {response.status_code}")
+                    fd = os.open(path, os.O_WRONLY)
+                    try:
+                        offset = start
+                        for data in response.iter_content(READ_SIZE):
+                            os.pwrite(fd, data, offset)
+                            offset += len(data)
+                    finally:
+                        os.close(fd)
+                if offset != end:
+                    raise IOError(f"Range ended at {offset}, expected {end}")
+                return
+            except (IOError, requests.exceptions.RequestException) as e:
+                if attempt == CHUNK_RETRIES - 1:
+                    raise
+                print(f"Retrying bytes {start}-{end} of {url}: {e}")
+
+    def download_stream(self, url, path):
+        # Servers without range requests get one stream, and no resume
+        with self.http.get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(path, "wb") as f:
+                for data in response.iter_content(READ_SIZE):
+                    f.write(data)
+        return os.path.getsize(path)
+
+    # Storing
+
+    def store_file(self, fileobj):
+        # Hashes while copying, so each byte is read once
+        tmp_path = os.path.join(self.blobs_dir, f"{uuid.uuid4().hex}.tmp")
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(tmp_path, "wb") as f:
+            while data := fileobj.read(READ_SIZE):
+                sha256.update(data)
+                f.write(data)
+                size += len(data)
+        digest = sha256.hexdigest()
+        with self.blobs_lock:
+            self.pending_blobs[digest] += 1
+            if os.path.exists(self.blob_path(digest)):
+                os.remove(tmp_path)
+            else:
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, self.blob_path(digest))
+        return {"sha256": digest, "size": size}
+
+    def release_blobs(self, files):
+        # The sidecar naming files is written, or storing them failed
+        with self.blobs_lock:
+            self.pending_blobs -= collections.Counter(f["sha256"] for f in files)
+
+    def store_archive(self, url, archive_path):
+        files = []
+        try:
+            with tarfile.open(archive_path) as archive:
+                for member in archive:
+                    if not member.isfile():
+                        continue
+                    path = os.path.normpath(member.name)
+                    if path.startswith("..") or os.path.isabs(path):
+                        raise ValueError(f"Unsafe path in {url}: {member.name}")
+                    files.append(
+                        {"path": path, **self.store_file(archive.extractfile(member))}
+                    )
+            return self.write_ref(url, files)
+        finally:
+            self.release_blobs(files)
+
+    def write_ref(self, url, files, dests=None):
+        # The sidecar is written last, once every blob it names is in place
+        ref = {
+            "url": url,
+            "files": files,
+            "dests": dests or [],
+            "stored_at": time.time(),
+        }
+        write_json(os.path.join(self.refs_dir, self.ref_name(url)), ref)
+        return ref
+
+    def refs(self):
+        for name in self.ref_names():
+            try:
+                with open(os.path.join(self.refs_dir, name)) as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
+
+    def remove(self, url):
+        # Unlinks the weight from its model directories and deletes its
+        # sidecar, then any blob no other weight uses. Returns bytes freed.
+        self.verified = {pair for pair in self.verified if pair[0] != url}
+        ref = self.read_ref(url)
+        if ref is None:
+            return 0
+        for dest in ref.get("dests", []):
+            for file in ref["files"]:
+                path = os.path.join(dest, file["path"])
+                try:
+                    if os.path.samefile(path, self.blob_path(file["sha256"])):
+                        os.remove(path)
+                except OSError:
+                    pass
+        os.remove(os.path.join(self.refs_dir, self.ref_name(url)))
+
+        freed = 0
+        with self.blobs_lock:
+            in_use = {f["sha256"] for other in self.refs() for f in other["files"]}
+            in_use.update(self.pending_blobs)
+            for file in ref["files"]:
+                if file["sha256"] in in_use:
+                    continue
+                try:
+                    os.remove(self.blob_path(file["sha256"]))
+                    freed += file["size"]
+                except FileNotFoundError:
+                    pass
+        return freed
+
+    def used_bytes(self):
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(self.blobs_dir)
+            if entry.name.isalnum()
+        )
+
+    # Linking into model directories
+
+    def is_materialised(self, ref, dest):
+        for file in ref["files"]:
+            try:
+                if not os.path.samefile(
+                    os.path.join(dest, file["path"]), self.blob_path(file["sha256"])
+                ):
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def materialise(self, ref, dest):
+        # Links are recorded in the sidecar so that eviction can remove them
+        if dest not in ref.setdefault("dests", []):
+            ref["dests"].append(dest)
+            write_json(os.path.join(self.refs_dir, self.ref_name(ref["url"])), ref)
+        for file in ref["files"]:
+            path = os.path.join(dest, file["path"])
+            blob = self.blob_path(file["sha256"])
+            try:
+                if os.path.samefile(path, blob):
+                    continue
+            except OSError:
+                pass
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Replaces whatever was there, such as a truncated extraction
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                os.link(blob, tmp_path)
+            except OSError as e:
+                if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+                    raise
+                os.symlink(os.path.abspath(blob), tmp_path)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        blobs = [entry for entry in os.scandir(self.blobs_dir) if entry.name.isalnum()]
+        return {
+            "weights": len(self.ref_names()),
+            "blobs": len(blobs),
+            "bytes": self.used_bytes(),
+        }